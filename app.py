@@ -2,27 +2,409 @@
 import os
 import sqlite3
 import base64
+import io
 import re
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
+import glob
+import tempfile
+import json
+import hashlib
+import gzip
+import csv
+import bisect
+import math
+import threading
+import time
+import click
+import functools
+import sys
+import unicodedata
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, g, make_response, Response
+from flask import before_render_template, template_rendered
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
+from markupsafe import Markup
+from PIL import Image, ImageOps
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_FOLDER = os.path.join('static', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
-app.config['SECRET_KEY'] = 'super-secret-key-change-me'
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or 'super-secret-key-change-me'
+app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, UPLOAD_FOLDER)
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB
 
+# Read here rather than in create_app so `flask` commands use it as well.
+app.config['DATABASE'] = os.environ.get('DATABASE') or os.path.join(BASE_DIR, 'app.db')
+app.config['DB_POOL_SIZE'] = 8
+app.config['DB_BUSY_TIMEOUT_MS'] = 5000
+
+# ---------- Metrics ----------
+# Request latency, SQL statement and template render timings, served in the
+# Prometheus text format at /metrics. Numbers are per process: with several
+# server processes each one reports its own.
+app.config['METRICS_ENABLED'] = True
+app.config['METRICS_TOKEN'] = None           # if set, /metrics wants "Authorization: Bearer <token>"
+app.config['METRICS_MAX_STATEMENTS'] = 500   # distinct SQL labels; later ones count as "other"
+app.config['SLOW_QUERY_MS'] = None           # log statements slower than this with their query plan
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .5, 1)
+
+metrics_registry = []
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(names, values):
+    return ','.join(f'{n}="{_label_value(v)}"' for n, v in zip(names, values))
+
+class Counter:
+    """Prometheus counter with one value per label tuple."""
+    kind = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{{{_label_text(self.labels, labels)}}} {value}"
+
+class Gauge(Counter):
+    """Prometheus gauge: the last value set per label tuple."""
+    kind = 'gauge'
+
+    def set(self, labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(Counter):
+    """Prometheus histogram; buckets are upper bounds in seconds."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][slot] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            text = _label_text(self.labels, labels)
+            running = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                running += count
+                yield f'{self.name}_bucket{{{text},le="{bound}"}} {running}'
+            yield f"{self.name}_sum{{{text}}} {total}"
+            yield f"{self.name}_count{{{text}}} {running}"
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+request_seconds = Histogram('http_request_duration_seconds', 'Time spent handling a request.',
+                            ('endpoint', 'method'), LATENCY_BUCKETS)
+requests_total = Counter('http_requests_total', 'Requests handled, by response status.',
+                         ('endpoint', 'method', 'status'))
+sql_seconds = Histogram('sql_statement_duration_seconds', 'Time to execute a statement up to its first row.',
+                        ('statement',), SQL_BUCKETS)
+sql_fetch_seconds = Counter('sql_fetch_seconds_total', 'Time spent in fetchone/fetchmany/fetchall.', ('statement',))
+sql_rows = Counter('sql_rows_fetched_total', 'Result rows fetched.', ('statement',))
+template_seconds = Histogram('template_render_duration_seconds', 'Time to render a Jinja template.',
+                             ('template',), LATENCY_BUCKETS)
+
+_statement_labels = {}
+_hot_query_names = None
+# Queries and DML: the statements that are timed, and that have a plan.
+QUERY_WITH_PLAN = re.compile(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b', re.I)
+_unmetered = threading.local()
+
+def statement_label(sql):
+    """Short stable label for a statement: its HOT_QUERIES name if it has
+    one, else its first keyword and a hash of its text. The full text is
+    logged once, when the label is first handed out."""
+    global _hot_query_names
+    label = _statement_labels.get(sql)
+    if label is None:
+        if len(_statement_labels) >= app.config['METRICS_MAX_STATEMENTS']:
+            return 'other'
+        if _hot_query_names is None:
+            _hot_query_names = {' '.join(q.split()): name for name, (q, _) in HOT_QUERIES.items()}
+        text = ' '.join(sql.split())
+        label = _hot_query_names.get(text) or \
+            f"{text.split(' ', 1)[0].lower()}_{hashlib.sha1(text.encode()).hexdigest()[:10]}"
+        _statement_labels[sql] = label
+        app.logger.info("SQL statement %s: %s", label, text)
+    return label
+
+def unmetered(fn):
+    """Leave the statements `fn` runs (schema setup) out of the SQL metrics."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        _unmetered.depth = getattr(_unmetered, 'depth', 0) + 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _unmetered.depth -= 1
+    return wrapper
+
+def log_slow_query(conn, sql, params, seconds):
+    # Parameters are left out of the log: they can hold emails and hashes.
+    plan = ''
+    if params is not None and QUERY_WITH_PLAN.match(sql):
+        try:
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            plan = ''.join(f"\n    {row[3]}" for row in rows)
+        except sqlite3.Error:
+            pass
+    app.logger.warning("Slow query (%.1f ms) %s: %s%s", seconds * 1000, statement_label(sql),
+                       ' '.join(sql.split()), plan)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records each statement's timing and rows into the metrics.
+
+    Rows read by iterating are counted here and recorded once, when the
+    cursor runs out, is closed or runs its next statement.
+    """
+    _label = None   # None: this statement isn't recorded
+    _iterated = 0
+
+    def _timed(self, run, sql, params):
+        self._count_iterated()
+        if getattr(_unmetered, 'depth', 0) or not QUERY_WITH_PLAN.match(sql):
+            self._label = None
+            return run(sql, params)
+        self._label = statement_label(sql)
+        start = time.perf_counter()
+        try:
+            return run(sql, params)
+        finally:
+            took = time.perf_counter() - start
+            sql_seconds.observe((self._label,), took)
+            slow_ms = app.config['SLOW_QUERY_MS']
+            if slow_ms is not None and took * 1000 >= slow_ms:
+                log_slow_query(self.connection, sql, params, took)
+
+    def execute(self, sql, params=()):
+        return self._timed(super().execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._timed(lambda sql, _: super(InstrumentedCursor, self).executemany(sql, seq_of_params),
+                           sql, None)
+
+    def _fetched(self, start, count):
+        if self._label is None:
+            return
+        sql_fetch_seconds.inc((self._label,), time.perf_counter() - start)
+        if count:
+            sql_rows.inc((self._label,), count)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __next__(self):
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._count_iterated()
+            raise
+        self._iterated += 1
+        return row
+
+    def _count_iterated(self):
+        if self._iterated:
+            if self._label is not None:
+                sql_rows.inc((self._label,), self._iterated)
+            self._iterated = 0
+
+    def close(self):
+        self._count_iterated()
+        super().close()
+
+    def __del__(self):
+        self._count_iterated()
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+_render_starts = threading.local()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    _render_starts.stack = []
+
+def _observe_request(status):
+    endpoint = request.endpoint or 'unmatched'
+    request_seconds.observe((endpoint, request.method), time.perf_counter() - g.pop('request_started'))
+    requests_total.inc((endpoint, request.method, str(status)))
+
+@app.after_request
+def record_request(response):
+    if 'request_started' in g:
+        _observe_request(response.status_code)
+    return response
+
+@app.teardown_request
+def record_failed_request(exc):
+    if 'request_started' in g:
+        _observe_request(500)
+
+@before_render_template.connect_via(app)
+def _template_started(sender, template, context, **extra):
+    if not hasattr(_render_starts, 'stack'):
+        _render_starts.stack = []
+    _render_starts.stack.append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _template_finished(sender, template, context, **extra):
+    stack = getattr(_render_starts, 'stack', None)
+    if stack:
+        template_seconds.observe((template.name or '<string>',), time.perf_counter() - stack.pop())
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Unauthorized\n', 401, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 # ---------- DB Utilities ----------
-def get_db():
-    conn = sqlite3.connect(os.path.join(BASE_DIR, 'app.db'))
+# Applied once when a connection is opened; pooled connections keep them.
+SQLITE_PRAGMAS = (
+    # New database files only, and only before WAL is switched on; `flask
+    # maintenance vacuum --full` converts an existing one.
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",          # readers no longer block on writers
+    "PRAGMA synchronous=NORMAL",        # safe with WAL, one fsync per checkpoint
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",       # 256MB memory-mapped reads
+    "PRAGMA cache_size=-32768",         # 32MB page cache per connection
+)
+
+def connect_db():
+    conn = sqlite3.connect(app.config['DATABASE'],
+                           timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000,
+                           check_same_thread=False,
+                           factory=InstrumentedConnection if app.config['METRICS_ENABLED'] else sqlite3.Connection)
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout={int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+class ConnectionPool:
+    """Keeps up to `size` open connections so requests skip connect + pragmas.
+
+    A connection is handed to one thread for the duration of a request and
+    returned on teardown; surplus connections are closed.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._database = None
+
+    def acquire(self):
+        with self._lock:
+            # A changed DATABASE setting invalidates everything we hold.
+            if self._database != app.config['DATABASE']:
+                self._close_idle()
+                self._database = app.config['DATABASE']
+            if self._idle:
+                return self._idle.pop()
+        return connect_db()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if self._database == app.config['DATABASE'] and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            self._close_idle()
+
+    def _close_idle(self):
+        while self._idle:
+            self._idle.pop().close()
+
+    def _after_fork(self):
+        # SQLite connections must not cross a fork. The child never uses or
+        # closes the parent's (closing could checkpoint the parent's WAL);
+        # it just keeps them referenced and starts empty.
+        self._forked_away = getattr(self, '_forked_away', []) + self._idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+db_pool = ConnectionPool(app.config['DB_POOL_SIZE'])
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=db_pool._after_fork)
+
+def get_db():
+    """Connection for the current request, reused until teardown."""
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+@unmetered
 def init_db():
     conn = get_db()
     cur = conn.cursor()
@@ -103,11 +485,1936 @@ def init_db():
         )
     """)
     conn.commit()
-    conn.close()
+    migrate_db(conn)
+
+# ---------- Schema migrations ----------
+# Recomputes the rating aggregates from scratch; the triggers keep them
+# current afterwards.
+BACKFILL_RATINGS_SQL = """
+    UPDATE products SET
+        review_count = (SELECT COUNT(*) FROM reviews r WHERE r.product_id = products.id),
+        rating_sum = (SELECT COALESCE(SUM(r.rating), 0) FROM reviews r WHERE r.product_id = products.id)
+"""
+
+# Recomputes the daily rollups from the rows still in products, orders and
+# reviews. The triggers keep them current afterwards, and keep counting
+# orders and reviews whose rows are later deleted or archived.
+def rebuild_stats_sql(order_revenue):
+    return (
+        "DELETE FROM farmer_daily_stats",
+        "DELETE FROM daily_stats",
+        f"""INSERT INTO farmer_daily_stats (farmer_id, day, listed, orders, revenue, sale_seconds, reviews, rating_sum)
+           SELECT farmer_id, day, SUM(listed), SUM(orders), SUM(revenue), SUM(sale_seconds), SUM(reviews), SUM(rating_sum)
+           FROM (
+               SELECT farmer_id, substr(created_at, 1, 10) AS day, 1 AS listed, 0 AS orders, 0 AS revenue,
+                      0 AS sale_seconds, 0 AS reviews, 0 AS rating_sum
+               FROM products
+               UNION ALL
+               SELECT o.farmer_id, substr(o.created_at, 1, 10), 0, 1, {order_revenue},
+                      (julianday(o.created_at) - julianday(p.created_at)) * 86400, 0, 0
+               FROM orders o JOIN products p ON p.id = o.product_id
+               UNION ALL
+               SELECT p.farmer_id, substr(r.created_at, 1, 10), 0, 0, 0, 0, 1, r.rating
+               FROM reviews r JOIN products p ON p.id = r.product_id
+           )
+           GROUP BY farmer_id, day""",
+        """INSERT INTO daily_stats (day, listed, orders, revenue, sale_seconds, reviews, rating_sum)
+           SELECT day, SUM(listed), SUM(orders), SUM(revenue), SUM(sale_seconds), SUM(reviews), SUM(rating_sum)
+           FROM farmer_daily_stats GROUP BY day""",
+    )
+
+REBUILD_STATS_SQL = rebuild_stats_sql('p.price * o.quantity')
+
+# MIGRATIONS[n - 1] upgrades the schema from version n-1 to n; PRAGMA
+# user_version records the last applied step. Only ever append to this list.
+# A step is a tuple of SQL statements or a callable taking the connection.
+MIGRATIONS = [
+    # 1: indexes for the hot read paths
+    (
+        "CREATE INDEX IF NOT EXISTS idx_products_unsold_created ON products(created_at) WHERE sold=0",
+        "CREATE INDEX IF NOT EXISTS idx_products_farmer_created ON products(farmer_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_products_created ON products(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_cart_buyer_product ON cart(buyer_id, product_id)",
+        "CREATE INDEX IF NOT EXISTS idx_reviews_product_rating ON reviews(product_id, rating)",
+        "CREATE INDEX IF NOT EXISTS idx_users_role_email ON users(role, email)",
+        "CREATE INDEX IF NOT EXISTS idx_users_role_phone ON users(role, phone)",
+    ),
+    # 2: per-product rating aggregates, maintained by triggers on reviews
+    (
+        "ALTER TABLE products ADD COLUMN review_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE products ADD COLUMN rating_sum INTEGER NOT NULL DEFAULT 0",
+        """CREATE TRIGGER IF NOT EXISTS trg_reviews_ai AFTER INSERT ON reviews BEGIN
+               UPDATE products SET review_count = review_count + 1, rating_sum = rating_sum + NEW.rating
+               WHERE id = NEW.product_id;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_reviews_ad AFTER DELETE ON reviews BEGIN
+               UPDATE products SET review_count = review_count - 1, rating_sum = rating_sum - OLD.rating
+               WHERE id = OLD.product_id;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_reviews_au AFTER UPDATE OF product_id, rating ON reviews BEGIN
+               UPDATE products SET review_count = review_count - 1, rating_sum = rating_sum - OLD.rating
+               WHERE id = OLD.product_id;
+               UPDATE products SET review_count = review_count + 1, rating_sum = rating_sum + NEW.rating
+               WHERE id = NEW.product_id;
+           END""",
+        BACKFILL_RATINGS_SQL,
+    ),
+    # 3: full-text index over product name/description for search & suggest
+    (
+        """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+               name, description, content='products', content_rowid='id',
+               prefix='2 3', tokenize='unicode61 remove_diacritics 2')""",
+        """CREATE TRIGGER IF NOT EXISTS trg_products_fts_ai AFTER INSERT ON products BEGIN
+               INSERT INTO products_fts(rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_products_fts_ad AFTER DELETE ON products BEGIN
+               INSERT INTO products_fts(products_fts, rowid, name, description)
+               VALUES ('delete', OLD.id, OLD.name, OLD.description);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_products_fts_au AFTER UPDATE OF name, description ON products BEGIN
+               INSERT INTO products_fts(products_fts, rowid, name, description)
+               VALUES ('delete', OLD.id, OLD.name, OLD.description);
+               INSERT INTO products_fts(rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+           END""",
+        # name matches weigh 10x description matches in the `rank` column
+        "INSERT INTO products_fts(products_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+        "INSERT INTO products_fts(products_fts) VALUES ('rebuild')",
+    ),
+    # 4: admin user listing pages by (created_at, id)
+    (
+        "CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)",
+    ),
+    # 5: resized WebP/JPEG copies of the product image, as JSON
+    #    {"webp": [[width, filename], ...], "jpg": [...]}
+    (
+        "ALTER TABLE products ADD COLUMN image_variants TEXT",
+    ),
+    # 6: content-addressed upload store with per-file reference counts
+    (
+        """CREATE TABLE IF NOT EXISTS uploads (
+               hash TEXT PRIMARY KEY,
+               filename TEXT NOT NULL UNIQUE,
+               size INTEGER NOT NULL,
+               refcount INTEGER NOT NULL DEFAULT 0,
+               variants TEXT,
+               created_at TEXT NOT NULL
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_uploads_unreferenced ON uploads(refcount) WHERE refcount <= 0",
+        """CREATE TRIGGER IF NOT EXISTS trg_products_uploads_ai AFTER INSERT ON products
+           WHEN NEW.image_filename IS NOT NULL BEGIN
+               UPDATE uploads SET refcount = refcount + 1 WHERE filename = NEW.image_filename;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_products_uploads_ad AFTER DELETE ON products
+           WHEN OLD.image_filename IS NOT NULL BEGIN
+               UPDATE uploads SET refcount = refcount - 1 WHERE filename = OLD.image_filename;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_products_uploads_au AFTER UPDATE OF image_filename ON products
+           WHEN OLD.image_filename IS NOT NEW.image_filename BEGIN
+               UPDATE uploads SET refcount = refcount - 1 WHERE filename = OLD.image_filename;
+               UPDATE uploads SET refcount = refcount + 1 WHERE filename = NEW.image_filename;
+           END""",
+    ),
+    # 7: tell uploads that were never attached to a product (still waiting
+    #    for their form, see /farmer/upload) from ones that were released
+    (
+        "ALTER TABLE uploads ADD COLUMN claimed INTEGER NOT NULL DEFAULT 0",
+        "UPDATE uploads SET claimed = 1 WHERE refcount > 0",
+        "DROP TRIGGER IF EXISTS trg_products_uploads_ai",
+        """CREATE TRIGGER trg_products_uploads_ai AFTER INSERT ON products
+           WHEN NEW.image_filename IS NOT NULL BEGIN
+               UPDATE uploads SET refcount = refcount + 1, claimed = 1 WHERE filename = NEW.image_filename;
+           END""",
+        "DROP TRIGGER IF EXISTS trg_products_uploads_au",
+        """CREATE TRIGGER trg_products_uploads_au AFTER UPDATE OF image_filename ON products
+           WHEN OLD.image_filename IS NOT NEW.image_filename BEGIN
+               UPDATE uploads SET refcount = refcount - 1 WHERE filename = OLD.image_filename;
+               UPDATE uploads SET refcount = refcount + 1, claimed = 1 WHERE filename = NEW.image_filename;
+           END""",
+    ),
+    # 8: notification outbox, and indexes for per-user feeds, unread counts
+    #    and retention of read notifications
+    (
+        """CREATE TABLE IF NOT EXISTS notification_outbox (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               kind TEXT NOT NULL,
+               payload TEXT NOT NULL,
+               created_at TEXT NOT NULL
+           )""",
+        "DROP INDEX IF EXISTS idx_notifications_user_created",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_user_id ON notifications(user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_unread ON notifications(user_id, id) WHERE is_read=0",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_read_created ON notifications(created_at) WHERE is_read=1",
+    ),
+    # 9: catalog version, bumped by any change that shows in listings or
+    #    search results; keys the fragment cache and catalog page ETags
+    (
+        """CREATE TABLE IF NOT EXISTS catalog_version (
+               id INTEGER PRIMARY KEY CHECK (id = 1),
+               version INTEGER NOT NULL,
+               changed_at TEXT NOT NULL
+           )""",
+        "INSERT OR IGNORE INTO catalog_version VALUES (1, 1, strftime('%Y-%m-%dT%H:%M:%S', 'now'))",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_products_ai AFTER INSERT ON products BEGIN
+               UPDATE catalog_version SET version = version + 1, changed_at = strftime('%Y-%m-%dT%H:%M:%S', 'now');
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_products_ad AFTER DELETE ON products BEGIN
+               UPDATE catalog_version SET version = version + 1, changed_at = strftime('%Y-%m-%dT%H:%M:%S', 'now');
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_products_au AFTER UPDATE OF
+               farmer_id, name, description, price, phone, image_filename, image_variants, sold,
+               review_count, rating_sum ON products BEGIN
+               UPDATE catalog_version SET version = version + 1, changed_at = strftime('%Y-%m-%dT%H:%M:%S', 'now');
+           END""",
+        # listings show the farmer's name and drop products of deleted farmers
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_users_au AFTER UPDATE OF name ON users
+           WHEN OLD.role = 'farmer' BEGIN
+               UPDATE catalog_version SET version = version + 1, changed_at = strftime('%Y-%m-%dT%H:%M:%S', 'now');
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_users_ad AFTER DELETE ON users
+           WHEN OLD.role = 'farmer' BEGIN
+               UPDATE catalog_version SET version = version + 1, changed_at = strftime('%Y-%m-%dT%H:%M:%S', 'now');
+           END""",
+    ),
+    # 10: daily sales/listing/review rollups per farmer and for the whole
+    #     marketplace, kept by triggers; reports read these instead of orders
+    (
+        """CREATE TABLE IF NOT EXISTS farmer_daily_stats (
+               farmer_id INTEGER NOT NULL,
+               day TEXT NOT NULL,
+               listed INTEGER NOT NULL DEFAULT 0,
+               orders INTEGER NOT NULL DEFAULT 0,
+               revenue REAL NOT NULL DEFAULT 0,
+               sale_seconds REAL NOT NULL DEFAULT 0,
+               reviews INTEGER NOT NULL DEFAULT 0,
+               rating_sum INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (farmer_id, day)
+           ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_farmer_daily_stats_day ON farmer_daily_stats(day)",
+        """CREATE TABLE IF NOT EXISTS daily_stats (
+               day TEXT PRIMARY KEY,
+               listed INTEGER NOT NULL DEFAULT 0,
+               orders INTEGER NOT NULL DEFAULT 0,
+               revenue REAL NOT NULL DEFAULT 0,
+               sale_seconds REAL NOT NULL DEFAULT 0,
+               reviews INTEGER NOT NULL DEFAULT 0,
+               rating_sum INTEGER NOT NULL DEFAULT 0
+           ) WITHOUT ROWID""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_products_ai AFTER INSERT ON products BEGIN
+               INSERT INTO farmer_daily_stats (farmer_id, day, listed)
+               VALUES (NEW.farmer_id, substr(NEW.created_at, 1, 10), 1)
+               ON CONFLICT (farmer_id, day) DO UPDATE SET listed = listed + 1;
+               INSERT INTO daily_stats (day, listed) VALUES (substr(NEW.created_at, 1, 10), 1)
+               ON CONFLICT (day) DO UPDATE SET listed = listed + 1;
+           END""",
+        # revenue is the listed price; time to sale runs from listing to order
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_orders_ai AFTER INSERT ON orders BEGIN
+               INSERT INTO farmer_daily_stats (farmer_id, day, orders, revenue, sale_seconds)
+               SELECT NEW.farmer_id, substr(NEW.created_at, 1, 10), 1, p.price,
+                      (julianday(NEW.created_at) - julianday(p.created_at)) * 86400
+               FROM products p WHERE p.id = NEW.product_id
+               ON CONFLICT (farmer_id, day) DO UPDATE SET orders = orders + 1,
+                   revenue = revenue + excluded.revenue, sale_seconds = sale_seconds + excluded.sale_seconds;
+               INSERT INTO daily_stats (day, orders, revenue, sale_seconds)
+               SELECT substr(NEW.created_at, 1, 10), 1, p.price,
+                      (julianday(NEW.created_at) - julianday(p.created_at)) * 86400
+               FROM products p WHERE p.id = NEW.product_id
+               ON CONFLICT (day) DO UPDATE SET orders = orders + 1,
+                   revenue = revenue + excluded.revenue, sale_seconds = sale_seconds + excluded.sale_seconds;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_reviews_ai AFTER INSERT ON reviews BEGIN
+               INSERT INTO farmer_daily_stats (farmer_id, day, reviews, rating_sum)
+               SELECT p.farmer_id, substr(NEW.created_at, 1, 10), 1, NEW.rating
+               FROM products p WHERE p.id = NEW.product_id
+               ON CONFLICT (farmer_id, day) DO UPDATE SET reviews = reviews + 1,
+                   rating_sum = rating_sum + excluded.rating_sum;
+               INSERT INTO daily_stats (day, reviews, rating_sum)
+               VALUES (substr(NEW.created_at, 1, 10), 1, NEW.rating)
+               ON CONFLICT (day) DO UPDATE SET reviews = reviews + 1, rating_sum = rating_sum + NEW.rating;
+           END""",
+        *rebuild_stats_sql('p.price'),   # orders have no quantity until step 11
+    ),
+    # 11: one cart row per (buyer, product), holding a quantity; orders keep
+    #     the quantity bought and revenue rollups count price x quantity
+    (
+        "DELETE FROM cart WHERE id NOT IN (SELECT MIN(id) FROM cart GROUP BY buyer_id, product_id)",
+        "DROP INDEX IF EXISTS idx_cart_buyer_product",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_buyer_product ON cart(buyer_id, product_id)",
+        "ALTER TABLE cart ADD COLUMN quantity INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE orders ADD COLUMN quantity INTEGER NOT NULL DEFAULT 1",
+        "DROP TRIGGER IF EXISTS trg_stats_orders_ai",
+        """CREATE TRIGGER trg_stats_orders_ai AFTER INSERT ON orders BEGIN
+               INSERT INTO farmer_daily_stats (farmer_id, day, orders, revenue, sale_seconds)
+               SELECT NEW.farmer_id, substr(NEW.created_at, 1, 10), 1, p.price * NEW.quantity,
+                      (julianday(NEW.created_at) - julianday(p.created_at)) * 86400
+               FROM products p WHERE p.id = NEW.product_id
+               ON CONFLICT (farmer_id, day) DO UPDATE SET orders = orders + 1,
+                   revenue = revenue + excluded.revenue, sale_seconds = sale_seconds + excluded.sale_seconds;
+               INSERT INTO daily_stats (day, orders, revenue, sale_seconds)
+               SELECT substr(NEW.created_at, 1, 10), 1, p.price * NEW.quantity,
+                      (julianday(NEW.created_at) - julianday(p.created_at)) * 86400
+               FROM products p WHERE p.id = NEW.product_id
+               ON CONFLICT (day) DO UPDATE SET orders = orders + 1,
+                   revenue = revenue + excluded.revenue, sale_seconds = sale_seconds + excluded.sale_seconds;
+           END""",
+    ),
+    # 12: which products (or farmers' products) each catalog version bump
+    #     touched, so in-memory catalog snapshots can catch up row by row;
+    #     trims itself to roughly the last 20000 entries
+    (
+        """CREATE TABLE IF NOT EXISTS catalog_changes (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               product_id INTEGER,
+               farmer_id INTEGER
+           )""",
+        """CREATE TRIGGER IF NOT EXISTS trg_changes_products_ai AFTER INSERT ON products BEGIN
+               INSERT INTO catalog_changes (product_id) VALUES (NEW.id);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_changes_products_ad AFTER DELETE ON products BEGIN
+               INSERT INTO catalog_changes (product_id) VALUES (OLD.id);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_changes_products_au AFTER UPDATE OF
+               farmer_id, name, description, price, phone, image_filename, image_variants, sold,
+               review_count, rating_sum ON products BEGIN
+               INSERT INTO catalog_changes (product_id) VALUES (NEW.id);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_changes_users_au AFTER UPDATE OF name ON users
+           WHEN OLD.role = 'farmer' BEGIN
+               INSERT INTO catalog_changes (farmer_id) VALUES (NEW.id);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_changes_users_ad AFTER DELETE ON users
+           WHEN OLD.role = 'farmer' BEGIN
+               INSERT INTO catalog_changes (farmer_id) VALUES (OLD.id);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_changes_prune AFTER INSERT ON catalog_changes
+           WHEN NEW.seq % 1000 = 0 BEGIN
+               DELETE FROM catalog_changes WHERE seq <= NEW.seq - 20000;
+           END""",
+    ),
+    # 13: indexes to find orders to archive, and the last run of each
+    #     maintenance task, which server processes use to take turns
+    (
+        "CREATE INDEX IF NOT EXISTS idx_orders_product ON orders(product_id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)",
+        """CREATE TABLE IF NOT EXISTS maintenance_runs (
+               task TEXT PRIMARY KEY,
+               started_at TEXT NOT NULL,
+               finished_at TEXT,
+               status TEXT,
+               result TEXT
+           )""",
+    ),
+]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db(conn):
+    """Apply pending migrations in place, one transaction per step.
+
+    The version is re-read under the write lock so concurrent callers never
+    apply the same step twice.
+    """
+    applied = []
+    for target in range(schema_version(conn) + 1, len(MIGRATIONS) + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) >= target:
+                conn.rollback()
+                continue
+            step = MIGRATIONS[target - 1]
+            if callable(step):
+                step(conn)
+            else:
+                for stmt in step:
+                    conn.execute(stmt)
+            conn.execute(f"PRAGMA user_version={target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(target)
+    return applied
+
+# Queries on the request hot paths; check_query_plans() fails if any of them
+# falls back to a full table scan.
+HOT_QUERIES = {
+    'buyer_dashboard.products': ("""
+        SELECT p.*, u.name AS farmer_name
+        FROM products p
+        JOIN users u ON p.farmer_id = u.id
+        WHERE p.sold = 0
+        ORDER BY p.created_at DESC
+    """, ()),
+    'farmer_dashboard.products': ("SELECT * FROM products WHERE farmer_id=? ORDER BY created_at DESC", (1,)),
+    'reviews.by_product': ("SELECT COUNT(id), AVG(rating) FROM reviews WHERE product_id=?", (1,)),
+    'login.by_email': ("SELECT * FROM users WHERE role='farmer' AND email=?", ('a@b.c',)),
+    'login.by_phone': ("SELECT * FROM users WHERE role='buyer' AND phone=?", ('9',)),
+}
+
+def full_scans(conn, sql, params=()):
+    """Plan steps of `sql` that read a whole table without an index."""
+    plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return [row['detail'] for row in plan
+            if row['detail'].startswith('SCAN ')
+            and ' USING ' not in row['detail'] and 'VIRTUAL TABLE INDEX' not in row['detail']]
+
+def check_query_plans(conn):
+    return {name: scans for name, (sql, params) in HOT_QUERIES.items()
+            if (scans := full_scans(conn, sql, params))}
+
+def migrated(fn):
+    """For `flask` commands: create and migrate the schema before running,
+    as create_app does for the server."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        init_db()
+        return fn(*args, **kwargs)
+    return wrapper
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create tables and apply pending migrations."""
+    init_db()
+    click.echo(f"Schema at version {schema_version(get_db())}.")
+
+@app.cli.command('check-plans')
+@migrated
+def check_plans_command():
+    """Fail if a hot-path query plans a full table scan."""
+    offenders = check_query_plans(get_db())
+    for name, scans in offenders.items():
+        click.echo(f"FULL SCAN {name}: {'; '.join(scans)}", err=True)
+    if offenders:
+        raise SystemExit(1)
+    click.echo(f"{len(HOT_QUERIES)} hot queries use indexes.")
+
+@app.cli.command('backfill-ratings')
+@migrated
+def backfill_ratings_command():
+    """Recompute products.review_count / rating_sum from the reviews table."""
+    conn = get_db()
+    cur = conn.execute(BACKFILL_RATINGS_SQL)
+    conn.commit()
+    click.echo(f"Recomputed ratings for {cur.rowcount} products.")
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# ---------- Upload store ----------
+# Uploaded images live under their SHA-256: <UPLOAD_FOLDER>/ab/cd/<hash>.<ext>.
+# Identical bytes share one file; the uploads table counts the products that
+# point at it (kept by triggers on products) and collect_uploads() removes
+# files nobody references any more. Files never change once written, which is
+# what lets uploaded_file() mark them immutable.
+app.config['UPLOAD_CHUNK_SIZE'] = 64 * 1024
+app.config['UPLOAD_MAX_BYTES'] = 8 * 1024 * 1024       # per image, however it arrives
+app.config['UPLOAD_CLAIM_GRACE'] = 3600                # seconds an unclaimed upload is kept
+app.config['UPLOAD_CACHE_MAX_AGE'] = 365 * 24 * 3600
+
+# Leading bytes of each accepted image format.
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+def sniff_image_type(head):
+    """File extension for the image whose first bytes are `head`, else None."""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+# Metadata that can identify whoever took the photo: camera EXIF (GPS
+# position, serial numbers), XMP and comments. Colour profiles are kept.
+IMAGE_PRIVATE_INFO = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+# GIF can't carry EXIF, so only these are rewritten.
+IMAGE_STRIP_FORMATS = {'jpg': ('JPEG', {}), 'png': ('PNG', {}), 'webp': ('WEBP', {'quality': 90})}
+
+def strip_image_metadata(path, ext):
+    """Rewrite the image at `path` without IMAGE_PRIVATE_INFO, turned upright
+    first since the orientation tag goes with the EXIF. Returns False,
+    leaving the file as it is, when there is nothing to strip."""
+    if ext not in IMAGE_STRIP_FORMATS:
+        return False
+    pil_format, params = IMAGE_STRIP_FORMATS[ext]
+    try:
+        with Image.open(path) as src:
+            if not any(key in src.info for key in IMAGE_PRIVATE_INFO):
+                return False
+            animated = getattr(src, 'is_animated', False)
+            turned = not animated and src.getexif().get(0x0112, 1) not in (None, 1)
+            im = ImageOps.exif_transpose(src) if turned else src
+            params = dict(params, save_all=animated)
+            if 'icc_profile' in src.info:
+                params['icc_profile'] = src.info['icc_profile']
+            if ext == 'jpg':
+                # Unturned JPEGs keep their quantisation tables: no visible loss.
+                params['quality'] = 95 if turned else 'keep'
+            for key in IMAGE_PRIVATE_INFO:
+                im.info.pop(key, None)
+            _save_atomic(im, path, pil_format, **params)
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError('Unreadable image') from e
+    return True
+
+StagedUpload = namedtuple('StagedUpload', 'path digest ext size')
+
+class UploadTooLarge(ValueError):
+    pass
+
+def stage_upload(stream):
+    """Copy an upload stream to a temp file in chunks, hashing as it goes.
+
+    Raises ValueError if the bytes are not a supported image and
+    UploadTooLarge past UPLOAD_MAX_BYTES, so memory stays at one chunk per
+    upload whatever the client sends. Location and camera metadata are
+    stripped before the file is hashed, since the original is served too.
+    The result is only written into the store by commit_upload().
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    max_bytes = app.config['UPLOAD_MAX_BYTES']
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            head = stream.read(chunk_size)
+            ext = sniff_image_type(head)
+            if ext is None:
+                raise ValueError('Unsupported image type')
+            chunk = head
+            while chunk:
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge('Image is larger than the upload limit')
+                chunk = stream.read(chunk_size)
+        if strip_image_metadata(tmp, ext):
+            with open(tmp, 'rb') as f:
+                digest = hashlib.file_digest(f, 'sha256')
+            size = os.path.getsize(tmp)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return StagedUpload(tmp, digest.hexdigest(), ext, size)
+
+DATA_URL_IMAGE = re.compile(r'^data:image/(png|jpeg|webp);base64$')
+
+def stage_data_url(data_url):
+    """Stage a `data:image/...;base64,` URL as posted by older camera forms."""
+    header, _, encoded = data_url.partition(',')
+    if not DATA_URL_IMAGE.match(header.strip()):
+        raise ValueError('Not an image data URL')
+    if len(encoded) > app.config['UPLOAD_MAX_BYTES'] * 4 // 3 + 4:
+        raise UploadTooLarge('Image is larger than the upload limit')
+    return stage_upload(io.BytesIO(base64.b64decode(encoded)))
+
+def discard_upload(staged):
+    if staged and os.path.exists(staged.path):
+        os.remove(staged.path)
+
+def commit_upload(conn, staged):
+    """Move a staged upload into the store.
+
+    Returns (filename, variants JSON, created); variants still need building
+    only when `created` is true. Must run inside the write transaction that
+    inserts the referencing product, so it cannot interleave with
+    collect_uploads().
+    """
+    created = conn.execute("SELECT 1 FROM uploads WHERE hash=?", (staged.digest,)).fetchone() is None
+    # An unreferenced copy uploaded again starts a fresh claim window, so
+    # collect_uploads() can't delete it before the new product claims it.
+    conn.execute("""INSERT INTO uploads (hash, filename, size, created_at) VALUES (?,?,?,?)
+                    ON CONFLICT (hash) DO UPDATE SET claimed = 0, created_at = excluded.created_at
+                    WHERE refcount <= 0""",
+                 (staged.digest, f"{staged.digest[:2]}/{staged.digest[2:4]}/{staged.digest}.{staged.ext}",
+                  staged.size, datetime.utcnow().isoformat()))
+    row = conn.execute("SELECT filename, variants FROM uploads WHERE hash=?", (staged.digest,)).fetchone()
+    dest = os.path.join(app.config['UPLOAD_FOLDER'], row['filename'])
+    if os.path.exists(dest):
+        os.remove(staged.path)
+    else:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(staged.path, dest)
+    return row['filename'], row['variants'], created
+
+def _remove_upload_files(filename):
+    folder = app.config['UPLOAD_FOLDER']
+    stem = os.path.splitext(filename)[0]
+    for path in [os.path.join(folder, filename)] + glob.glob(os.path.join(folder, glob.escape(stem) + '_*w.*')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def collect_uploads(conn):
+    """Delete stored files that no product references; returns how many."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Fresh uploads from /farmer/upload wait at refcount 0 until the
+        # product form that uses them is submitted.
+        cutoff = datetime.utcfromtimestamp(time.time() - app.config['UPLOAD_CLAIM_GRACE']).isoformat()
+        rows = conn.execute("""SELECT hash, filename FROM uploads
+                               WHERE refcount <= 0 AND (claimed = 1 OR created_at < ?)""",
+                            (cutoff,)).fetchall()
+        conn.executemany("DELETE FROM uploads WHERE hash=?", [(r['hash'],) for r in rows])
+        for r in rows:
+            _remove_upload_files(r['filename'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+@app.cli.command('gc-uploads')
+@migrated
+def gc_uploads_command():
+    """Remove unreferenced uploads and stray files in the upload store."""
+    conn = get_db()
+    removed = collect_uploads(conn)
+    known = {r['filename'] for r in conn.execute("SELECT filename FROM uploads")}
+    folder = app.config['UPLOAD_FOLDER']
+    strays = 0
+    for path in glob.glob(os.path.join(folder, '[0-9a-f][0-9a-f]', '[0-9a-f][0-9a-f]', '*')):
+        rel = os.path.relpath(path, folder).replace(os.sep, '/')
+        original = re.sub(r'_\d+w\.\w+$', '', rel)
+        if rel not in known and not any(k.startswith(original + '.') for k in known):
+            os.remove(path); strays += 1
+    # Temp files left behind by uploads that died mid-stream.
+    for path in glob.glob(os.path.join(folder, '*.part')):
+        if os.path.getmtime(path) < time.time() - 3600:
+            os.remove(path); strays += 1
+    click.echo(f"Removed {removed} unreferenced uploads and {strays} stray files.")
+
+@app.cli.command('migrate-uploads')
+@migrated
+def migrate_uploads_command():
+    """Move uploads saved under timestamp names into the content-addressed store."""
+    conn = get_db()
+    folder = app.config['UPLOAD_FOLDER']
+    legacy = [r['image_filename'] for r in conn.execute(
+        "SELECT DISTINCT image_filename FROM products WHERE image_filename NOT LIKE '%/%'")]
+    moved = 0
+    for old in legacy:
+        path = os.path.join(folder, old)
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path, 'rb') as fh:
+                staged = stage_upload(fh)
+        except ValueError:
+            click.echo(f"Skipping {old}: not a supported image", err=True)
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            filename, variants, created = commit_upload(conn, staged)
+            conn.execute("UPDATE products SET image_filename=?, image_variants=? WHERE image_filename=?",
+                         (filename, variants, old))
+            conn.commit()
+        except Exception:
+            conn.rollback(); discard_upload(staged)
+            raise
+        if created:
+            process_upload_image(filename)
+        _remove_upload_files(old)
+        moved += 1
+    catalog_changed()
+    click.echo(f"Moved {moved} of {len(legacy)} legacy uploads.")
+
+# ---------- Image pipeline ----------
+# Each stored upload is auto-oriented, stripped of EXIF, capped in size and
+# resized into responsive WebP/JPEG variants on a background thread, so
+# farmer_add only has to save the upload. The largest variant is the full
+# capped image; the original keeps its pixels but not its metadata (see
+# strip_image_metadata).
+app.config['IMAGE_MAX_DIMENSION'] = 1600
+app.config['IMAGE_WIDTHS'] = (320, 640, 1024)
+app.config['IMAGE_WORKERS'] = 2   # 0 processes images inline (tests, scripts)
+
+IMAGE_VARIANT_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+image_executor = ThreadPoolExecutor(max_workers=max(app.config['IMAGE_WORKERS'], 1),
+                                    thread_name_prefix='image')
+
+def _save_atomic(im, path, fmt, **params):
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    im.save(tmp, format=fmt, **params)
+    os.replace(tmp, path)
+
+def build_image_variants(filename):
+    """Write metadata-free resized copies of an upload next to it."""
+    folder = app.config['UPLOAD_FOLDER']
+    stem = os.path.splitext(filename)[0]
+    max_dim = app.config['IMAGE_MAX_DIMENSION']
+    with Image.open(os.path.join(folder, filename)) as src:
+        im = ImageOps.exif_transpose(src)
+        im.thumbnail((max_dim, max_dim))
+    if im.mode not in ('RGB', 'L'):
+        flat = Image.new('RGB', im.size, 'white')
+        flat.paste(im, mask=im.convert('RGBA').getchannel('A'))
+        im = flat
+    # Pillow only writes EXIF/ICC/text chunks when asked to, so none survive.
+    widths = sorted({min(w, im.width) for w in app.config['IMAGE_WIDTHS']} | {im.width})
+    variants = {ext: [] for ext, _, _ in IMAGE_VARIANT_FORMATS}
+    for width in widths:
+        resized = im if width == im.width else im.resize(
+            (width, max(1, round(im.height * width / im.width))), Image.LANCZOS)
+        for ext, pil_format, params in IMAGE_VARIANT_FORMATS:
+            name = f"{stem}_{width}w.{ext}"
+            _save_atomic(resized, os.path.join(folder, name), pil_format, **params)
+            variants[ext].append([width, name])
+    return variants
+
+def process_upload_image(filename):
+    try:
+        variants = json.dumps(build_image_variants(filename))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        app.logger.warning("Could not process image %s", filename, exc_info=True)
+        return
+    conn = db_pool.acquire()
+    try:
+        # Covers every product sharing this upload, including ones inserted
+        # while the variants were being built.
+        conn.execute("UPDATE uploads SET variants=? WHERE filename=?", (variants, filename))
+        conn.execute("UPDATE products SET image_variants=? WHERE image_filename=?", (variants, filename))
+        conn.commit()
+    finally:
+        db_pool.release(conn)
+    catalog_changed()
+
+def queue_image_processing(filename):
+    if app.config['IMAGE_WORKERS']:
+        image_executor.submit(process_upload_image, filename)
+    else:
+        process_upload_image(filename)
+
+@app.cli.command('process-images')
+@migrated
+def process_images_command():
+    """Build image variants for products uploaded before the pipeline existed."""
+    rows = get_db().execute("""SELECT DISTINCT image_filename FROM products
+                               WHERE image_filename IS NOT NULL AND image_variants IS NULL""").fetchall()
+    for row in rows:
+        process_upload_image(row['image_filename'])
+    click.echo(f"Processed {len(rows)} product images.")
+
+@app.template_filter('image_variants')
+def image_variants_filter(product):
+    return json.loads(product['image_variants']) if product['image_variants'] else None
+
+@app.template_filter('srcset')
+def srcset_filter(variants):
+    return ', '.join(f"{url_for('uploaded_file', filename=name)} {width}w" for width, name in variants)
+
+# ---------- Caches ----------
+class TTLCache:
+    """Small thread-safe LRU whose entries also expire after `ttl` seconds."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# Suggestions, keyed on the catalog version and the normalized query.
+app.config['SUGGEST_CACHE_SIZE'] = 2048
+app.config['SUGGEST_CACHE_TTL'] = 60     # seconds an entry may live in this process
+app.config['SUGGEST_MAX_AGE'] = 30       # seconds browsers may reuse a response
+
+suggest_cache = TTLCache(app.config['SUGGEST_CACHE_SIZE'], app.config['SUGGEST_CACHE_TTL'])
+
+# Rendered product tiles, keyed on the catalog version so any product change
+# (from any process) moves readers on to fresh entries.
+app.config['FRAGMENT_CACHE_SIZE'] = 512
+app.config['FRAGMENT_CACHE_TTL'] = 300
+
+fragment_cache = TTLCache(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+
+def catalog_changed():
+    """Call after a product is added, removed, sold or reviewed."""
+    suggest_cache.clear()
+    fragment_cache.clear()
+
+def catalog_version():
+    """(version, last change as a UTC datetime), read once per request."""
+    if 'catalog_version' not in g:
+        row = get_db().execute("SELECT version, changed_at FROM catalog_version WHERE id=1").fetchone()
+        g.catalog_version = (row['version'], datetime.fromisoformat(row['changed_at']).replace(tzinfo=timezone.utc))
+    return g.catalog_version
+
+def cached_fragment(key, render):
+    """render() for this catalog version, or its earlier result."""
+    key = (catalog_version()[0], *key)
+    value = fragment_cache.get(key)
+    if value is None:
+        value = render()
+        fragment_cache.set(key, value)
+    return value
+
+def _pages_build_id():
+    # Changes whenever the code or a template is redeployed, so ETags from an
+    # older build never match.
+    paths = [__file__, *glob.glob(os.path.join(BASE_DIR, 'templates', '*.html'))]
+    return str(max(int(os.path.getmtime(path)) for path in paths))
+
+app.config['PAGES_BUILD_ID'] = _pages_build_id()
+
+def catalog_conditional(view):
+    """Answer repeat GETs with 304 while the catalog and the visitor's
+    session (nav bar, language) are unchanged.
+
+    Pages carrying one-off flash messages are always rendered in full.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if '_flashes' in session:
+            return view(*args, **kwargs)
+        version, changed_at = catalog_version()
+        etag = hashlib.sha1(repr((
+            app.config['PAGES_BUILD_ID'], version, request.full_path,
+            session.get('user_id'), session.get('role'), session.get('name'), session.get('lang'),
+        )).encode()).hexdigest()
+        if not is_resource_modified(request.environ, etag=etag, last_modified=changed_at):
+            resp = app.response_class(status=304)
+        else:
+            resp = make_response(view(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+        resp.set_etag(etag, weak=True)
+        resp.last_modified = changed_at
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+        resp.vary.add('Cookie')
+        return resp
+    return wrapper
+
+# ---------- Compression ----------
+# HTML and JSON bodies are compressed for clients that accept it: brotli if
+# the optional `brotli` package is installed, else gzip. Streamed responses
+# and files sent by send_file are left alone.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+app.config['COMPRESS_MIN_SIZE'] = 500
+app.config['COMPRESS_LEVEL'] = 6          # gzip level; brotli uses COMPRESS_BROTLI_QUALITY
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+app.config['COMPRESS_MIMETYPES'] = {'text/html', 'application/json', 'text/css', 'text/javascript',
+                                    'application/javascript', 'image/svg+xml', 'text/plain'}
+
+@app.after_request
+def compress_response(resp):
+    if (resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed
+            or resp.mimetype not in app.config['COMPRESS_MIMETYPES'] or 'Content-Encoding' in resp.headers):
+        return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    body = resp.get_data()
+    if not encoding or len(body) < app.config['COMPRESS_MIN_SIZE']:
+        return resp
+    if encoding == 'br':
+        resp.set_data(brotli.compress(body, quality=app.config['COMPRESS_BROTLI_QUALITY']))
+    else:
+        resp.set_data(gzip.compress(body, compresslevel=app.config['COMPRESS_LEVEL']))
+    resp.headers['Content-Encoding'] = encoding
+    # The bytes differ per encoding, so a strong validator can only stay as a weak one.
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+# ---------- Catalog snapshot ----------
+# Optional in-process copy of the unsold catalog that the listing, filter and
+# suggest paths read instead of SQLite. The database stays the source of
+# truth: a request that sees a newer catalog version (migration 9) than the
+# snapshot first replays catalog_changes (migration 12) since the snapshot
+# last caught up, reloading only those products. Every worker process does
+# the same, so writes from any of them show up in all. Full-text search
+# (ranked over descriptions too) still goes to SQLite.
+app.config['CATALOG_SNAPSHOT'] = False
+app.config['CATALOG_SNAPSHOT_RELOAD_AFTER'] = 5000   # further behind than this, reload everything
+
+CATALOG_FIELDS = ('id', 'farmer_id', 'name', 'description', 'price', 'phone', 'image_filename',
+                  'image_variants', 'created_at', 'review_count', 'rating_sum', 'farmer_name')
+
+CATALOG_SNAPSHOT_SQL = """
+    SELECT p.id, p.farmer_id, p.name, p.description, p.price, p.phone, p.image_filename,
+           p.image_variants, p.created_at, p.review_count, p.rating_sum, u.name AS farmer_name
+    FROM products p JOIN users u ON p.farmer_id = u.id
+    WHERE p.sold = 0 {where}
+"""
+
+snapshot_products = Gauge('catalog_snapshot_products', 'Products held in the in-memory catalog.', ())
+snapshot_bytes = Gauge('catalog_snapshot_bytes', 'Approximate memory held by the in-memory catalog, '
+                       'as measured at its last full load.', ())
+snapshot_syncs = Counter('catalog_snapshot_syncs_total', 'Times the in-memory catalog caught up with the '
+                         'database, by kind (full reload or incremental).', ('kind',))
+
+class CatalogProduct:
+    """An unsold product; reads like a sqlite3.Row, as p['name'] or p.name."""
+    __slots__ = CATALOG_FIELDS
+    sold = 0
+
+    def __init__(self, row):
+        for field in CATALOG_FIELDS:
+            setattr(self, field, row[field])
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def keys(self):
+        return CATALOG_FIELDS
+
+def name_tokens(text):
+    """Words of `text` the way the FTS index splits them (unicode61 with
+    remove_diacritics): lower-cased, split at anything but letters and
+    digits, accents dropped."""
+    tokens = re.findall(r'[^\W_]+', text.casefold())
+    if not text.isascii():
+        tokens = [''.join(ch for ch in unicodedata.normalize('NFKD', t) if not unicodedata.combining(ch))
+                  for t in tokens]
+    return tokens
+
+@contextmanager
+def read_snapshot(conn):
+    """Run the reads inside one transaction so they all see the same data."""
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+
+class CatalogSnapshot:
+    """Unsold products by id, plus sorted indexes: (created_at, id) for
+    newest-first listing pages, overall and per farmer, and (name token, id)
+    for prefix lookups."""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.database = None
+        self.version = None      # catalog version the data reflects
+        self.seq = 0             # last catalog_changes row applied
+        self.bytes = 0
+        self._products = {}
+        self._order = []
+        self._by_farmer = {}
+        self._names = []
+
+    def __len__(self):
+        return len(self._products)
+
+    def _sync(self):
+        """Catch up with the catalog version this request sees."""
+        if self.database != app.config['DATABASE'] or self.version is None:
+            self.load()
+        elif self.version < catalog_version()[0]:
+            self._catch_up()
+
+    def load(self):
+        """Read every unsold product afresh."""
+        with self._lock, read_snapshot(get_db()) as conn:
+            version = conn.execute("SELECT version FROM catalog_version WHERE id=1").fetchone()[0]
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM catalog_changes").fetchone()[0]
+            rows = conn.execute(CATALOG_SNAPSHOT_SQL.format(where='')).fetchall()
+            self._reset()
+            # Share one string per farmer name and phone instead of one per product.
+            shared = {}
+            for row in rows:
+                p = CatalogProduct(row)
+                p.farmer_name = shared.setdefault(p.farmer_name, p.farmer_name)
+                p.phone = shared.setdefault(p.phone, p.phone)
+                self._products[p.id] = p
+            self._order = sorted((p.created_at, p.id) for p in self._products.values())
+            for key in self._order:
+                self._by_farmer.setdefault(self._products[key[1]].farmer_id, []).append(key)
+            self._names = sorted((sys.intern(t), p.id) for p in self._products.values() for t in name_tokens(p.name))
+            self.database, self.version, self.seq = app.config['DATABASE'], version, seq
+            self.bytes = self.memory_usage()
+        snapshot_syncs.inc(('full',))
+        snapshot_products.set((), len(self._products))
+        snapshot_bytes.set((), self.bytes)
+
+    def _catch_up(self):
+        with read_snapshot(get_db()) as conn:
+            version = conn.execute("SELECT version FROM catalog_version WHERE id=1").fetchone()[0]
+            changes = conn.execute("SELECT seq, product_id, farmer_id FROM catalog_changes WHERE seq > ? "
+                                   "ORDER BY seq LIMIT ?",
+                                   (self.seq, app.config['CATALOG_SNAPSHOT_RELOAD_AFTER'] + 1)).fetchall()
+            # Every version bump logs a change; a gap (or none at all) means
+            # the ones we need were already trimmed away.
+            if (not changes or changes[0]['seq'] != self.seq + 1
+                    or len(changes) > app.config['CATALOG_SNAPSHOT_RELOAD_AFTER']):
+                return self.load()
+            product_ids = {c['product_id'] for c in changes if c['product_id'] is not None}
+            farmer_ids = {c['farmer_id'] for c in changes if c['farmer_id'] is not None}
+            if farmer_ids:
+                product_ids.update(p.id for p in self._products.values() if p.farmer_id in farmer_ids)
+            rows = conn.execute(CATALOG_SNAPSHOT_SQL.format(where='AND p.id IN (SELECT value FROM json_each(?))'),
+                                (json.dumps(sorted(product_ids)),)).fetchall()
+            if farmer_ids:
+                rows += conn.execute(CATALOG_SNAPSHOT_SQL.format(
+                    where='AND p.farmer_id IN (SELECT value FROM json_each(?))'),
+                    (json.dumps(sorted(farmer_ids)),)).fetchall()
+        for pid in product_ids:
+            self._remove(pid)
+        for row in rows:
+            self._remove(row['id'])
+            self._add(CatalogProduct(row))
+        self.version, self.seq = version, changes[-1]['seq']
+        snapshot_syncs.inc(('incremental',))
+        snapshot_products.set((), len(self._products))
+
+    def _add(self, p):
+        self._products[p.id] = p
+        key = (p.created_at, p.id)
+        bisect.insort(self._order, key)
+        bisect.insort(self._by_farmer.setdefault(p.farmer_id, []), key)
+        for token in name_tokens(p.name):
+            bisect.insort(self._names, (sys.intern(token), p.id))
+
+    def _remove(self, pid):
+        p = self._products.pop(pid, None)
+        if p is None:
+            return
+        del self._order[bisect.bisect_left(self._order, (p.created_at, p.id))]
+        listed = self._by_farmer[p.farmer_id]
+        del listed[bisect.bisect_left(listed, (p.created_at, p.id))]
+        if not listed:
+            del self._by_farmer[p.farmer_id]
+        for token in name_tokens(p.name):
+            i = bisect.bisect_left(self._names, (token, pid))
+            if i < len(self._names) and self._names[i] == (token, pid):
+                del self._names[i]
+
+    def _matching(self, word, prefix):
+        """Ids of products with `word` (or, if `prefix`, any word starting
+        with it) in their name."""
+        ids = set()
+        for i in range(bisect.bisect_left(self._names, (word,)), len(self._names)):
+            token, pid = self._names[i]
+            if token != word and not (prefix and token.startswith(word)):
+                break
+            ids.add(pid)
+        return ids
+
+    def page(self, after, size, filters):
+        """Up to size + 1 products older than the (created_at, id) key
+        `after`, newest first, that pass every filter."""
+        tests = [(LISTING_FILTERS[name][2], value) for name, value in filters.items()]
+        if after and not (isinstance(after[0], str) and isinstance(after[1], int)):
+            return []
+        with self._lock:
+            self._sync()
+            order = self._by_farmer.get(filters['farmer'], []) if 'farmer' in filters else self._order
+            end = bisect.bisect_left(order, tuple(after)) if after else len(order)
+            rows = []
+            for i in range(end - 1, -1, -1):
+                p = self._products[order[i][1]]
+                if all(test(p, value) for test, value in tests):
+                    rows.append(p)
+                    if len(rows) > size:
+                        break
+        return rows
+
+    def suggest(self, groups, limit=5):
+        """Distinct names of products whose name words match every group of
+        alternative prefixes, best rated first, like SUGGEST_SQL (which also
+        weighs how well the words match)."""
+        with self._lock:
+            self._sync()
+            ids = None
+            for alternatives in groups:
+                found = set()
+                for alternative in alternatives:
+                    # Like the FTS phrase "words" *: the last word is a
+                    # prefix (word order is not checked here).
+                    tokens = name_tokens(alternative)
+                    if tokens:
+                        found |= set.intersection(*(self._matching(t, i == len(tokens) - 1)
+                                                    for i, t in enumerate(tokens)))
+                ids = found if ids is None else ids & found
+                if not ids:
+                    return []
+            by_name = {}
+            for pid in ids:
+                p = self._products[pid]
+                counts = by_name.setdefault(p.name, [0, 0])
+                counts[0] += p.review_count
+                counts[1] += p.rating_sum
+        results = [{'name': name, 'avg_rating': rating_sum / reviews if reviews else 0, 'review_count': reviews}
+                   for name, (reviews, rating_sum) in by_name.items()]
+        results.sort(key=lambda r: (-r['avg_rating'], -r['review_count'], r['name']))
+        return results[:limit]
+
+    def memory_usage(self):
+        """Bytes held by the records, their values and the indexes,
+        counting objects shared between products once."""
+        seen, total = set(), 0
+        def add(obj):
+            nonlocal total
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+        for container in (self._products, self._order, self._by_farmer, self._names,
+                          *self._by_farmer.values()):
+            add(container)
+        for p in self._products.values():
+            add(p)
+            for field in CATALOG_FIELDS:
+                add(getattr(p, field))
+        for entries in (self._order, self._names):
+            for entry in entries:
+                add(entry)
+                add(entry[0])
+        return total
+
+catalog_snapshot = CatalogSnapshot()
+
+@app.cli.command('catalog-snapshot')
+@migrated
+def catalog_snapshot_command():
+    """Load the in-memory catalog and report its size."""
+    with app.test_request_context():
+        started = time.perf_counter()
+        catalog_snapshot.load()
+        took = time.perf_counter() - started
+    count = len(catalog_snapshot)
+    click.echo(f"{count:,} products, {catalog_snapshot.bytes / 2**20:.1f} MiB "
+               f"({catalog_snapshot.bytes / max(count, 1):.0f} bytes per product), loaded in {took:.2f}s.")
+
+# ---------- Notifications ----------
+# Request handlers only append one event to notification_outbox inside their
+# own transaction. A background thread fans events out into per-user
+# notifications in batches and wakes the open event streams of this process;
+# the poll interval picks up events queued by other processes.
+app.config['OUTBOX_BATCH_SIZE'] = 500
+app.config['OUTBOX_POLL_SECONDS'] = 5
+app.config['OUTBOX_WORKER'] = True           # False flushes inline after each commit (tests, scripts)
+app.config['NOTIFY_RETENTION_DAYS'] = 30     # read notifications older than this are deleted
+app.config['NOTIFY_COMPACT_SECONDS'] = 3600  # how often the worker runs that cleanup
+app.config['NOTIFY_STREAM_SECONDS'] = 300    # streams then end and the browser reconnects
+app.config['NOTIFY_HEARTBEAT_SECONDS'] = 15
+app.config['NOTIFY_MAX_STREAMS'] = None      # per process; over it streams get a 503 and the page polls
+app.config['NOTIFY_RETRY_SECONDS'] = 30      # how long a refused browser waits before trying again
+
+notification_streams = Gauge('notification_streams_open', 'Event streams open in this process.', ())
+notification_streams_refused = Counter('notification_streams_refused_total', 'Event streams refused '
+                                       'because NOTIFY_MAX_STREAMS were already open.', ())
+
+def queue_notification(conn, kind, payload):
+    """Record an event in the caller's open transaction; fan-out happens later."""
+    conn.execute("INSERT INTO notification_outbox (kind, payload, created_at) VALUES (?,?,?)",
+                 (kind, json.dumps(payload), datetime.utcnow().isoformat()))
+
+def _order_placed(conn, event):
+    for product_id, farmer_id in event['items']:
+        yield farmer_id, f"Your product #{product_id} was ordered (Cash on Delivery)."
+        yield event['buyer_id'], f"Order placed for product #{product_id} (COD)."
+
+def _review_posted(conn, event):
+    product = conn.execute("SELECT farmer_id, name FROM products WHERE id=?", (event['product_id'],)).fetchone()
+    if product:
+        yield product['farmer_id'], f"New {event['rating']}★ review on {product['name']}."
+
+# kind -> function(conn, payload) yielding (user_id, message) pairs
+NOTIFICATION_EVENTS = {
+    'order_placed': _order_placed,
+    'review_posted': _review_posted,
+}
+
+class NotificationHub:
+    """Lets event streams sleep until their user is sent something new.
+
+    Each user has a counter bumped on every publish; a stream reads it before
+    querying and then waits for it to move.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._versions = {}
+        self._streams = 0
+
+    def version(self, user_id):
+        with self._cond:
+            return self._versions.get(user_id, 0)
+
+    def publish(self, user_ids):
+        with self._cond:
+            for user_id in user_ids:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._cond.notify_all()
+
+    def wait(self, user_id, version, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._versions.get(user_id, 0) > version, timeout)
+
+    def claim_stream(self, limit):
+        """Count one more open stream, or return False if `limit` already are.
+
+        Each open stream holds a request thread for its whole life, so the
+        cap keeps some of the pool free for ordinary page requests.
+        """
+        with self._cond:
+            if limit is not None and self._streams >= limit:
+                return False
+            self._streams += 1
+            notification_streams.set((), self._streams)
+            return True
+
+    def release_stream(self):
+        with self._cond:
+            self._streams -= 1
+            notification_streams.set((), self._streams)
+
+notification_hub = NotificationHub()
+
+def flush_outbox(conn, limit):
+    """Turn up to `limit` queued events into notifications.
+
+    Returns (events flushed, ids of the users notified).
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        events = conn.execute("SELECT * FROM notification_outbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+        if not events:
+            conn.rollback()
+            return 0, set()
+        notes = []
+        for event in events:
+            fanout = NOTIFICATION_EVENTS.get(event['kind'])
+            if fanout is None:
+                app.logger.warning("Dropping notification event of unknown kind %r", event['kind'])
+                continue
+            notes.extend((user_id, message, event['created_at'])
+                         for user_id, message in fanout(conn, json.loads(event['payload'])))
+        conn.executemany("INSERT INTO notifications (user_id, message, created_at) VALUES (?,?,?)", notes)
+        conn.execute("DELETE FROM notification_outbox WHERE id <= ?", (events[-1]['id'],))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(events), {user_id for user_id, _, _ in notes}
+
+def drain_outbox():
+    """Flush the outbox batch by batch until it is empty."""
+    conn = db_pool.acquire()
+    try:
+        total = 0
+        while True:
+            flushed, user_ids = flush_outbox(conn, app.config['OUTBOX_BATCH_SIZE'])
+            if not flushed:
+                return total
+            total += flushed
+            notification_hub.publish(user_ids)
+    finally:
+        db_pool.release(conn)
+
+def compact_notifications(conn, days, batch=1000):
+    """Delete read notifications older than `days`, a batch per transaction."""
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    removed = 0
+    while True:
+        cur = conn.execute("""DELETE FROM notifications WHERE id IN (
+                                  SELECT id FROM notifications WHERE is_read=1 AND created_at < ? LIMIT ?)""",
+                           (cutoff, batch))
+        conn.commit()
+        removed += cur.rowcount
+        if cur.rowcount < batch:
+            return removed
+
+_outbox_wakeup = threading.Event()
+_outbox_lock = threading.Lock()
+_outbox_thread = None
+
+def _outbox_worker():
+    next_compaction = time.monotonic()
+    while True:
+        _outbox_wakeup.wait(app.config['OUTBOX_POLL_SECONDS'])
+        _outbox_wakeup.clear()
+        try:
+            drain_outbox()
+            if time.monotonic() >= next_compaction:
+                conn = db_pool.acquire()
+                try:
+                    compact_notifications(conn, app.config['NOTIFY_RETENTION_DAYS'])
+                finally:
+                    db_pool.release(conn)
+                next_compaction = time.monotonic() + app.config['NOTIFY_COMPACT_SECONDS']
+        except sqlite3.Error:
+            app.logger.exception("Notification outbox flush failed")
+
+def start_outbox_worker():
+    """Start this process's outbox thread if it isn't running (e.g. after a fork)."""
+    global _outbox_thread
+    with _outbox_lock:
+        if _outbox_thread is None or not _outbox_thread.is_alive():
+            _outbox_thread = threading.Thread(target=_outbox_worker, name='outbox', daemon=True)
+            _outbox_thread.start()
+
+def outbox_changed():
+    """Call after committing a transaction that queued notifications."""
+    if app.config['OUTBOX_WORKER']:
+        start_outbox_worker()
+        _outbox_wakeup.set()
+    else:
+        drain_outbox()
+
+NOTIFICATION_FEED_SQL = """
+    SELECT id, message, is_read, created_at FROM notifications
+    WHERE user_id=? {before}
+    ORDER BY id DESC
+    LIMIT ?
+"""
+NOTIFICATIONS_SINCE_SQL = """
+    SELECT id, message, is_read, created_at FROM notifications
+    WHERE user_id=? AND id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+UNREAD_COUNT_SQL = "SELECT COUNT(*) FROM notifications WHERE user_id=? AND is_read=0"
+
+HOT_QUERIES['notifications.feed'] = (NOTIFICATION_FEED_SQL.format(before='AND id < ?'), (1, 100, 21))
+HOT_QUERIES['notifications.since'] = (NOTIFICATIONS_SINCE_SQL, (1, 100, 100))
+HOT_QUERIES['notifications.unread'] = (UNREAD_COUNT_SQL, (1,))
+
+@app.cli.command('flush-notifications')
+@migrated
+def flush_notifications_command():
+    """Fan out queued notification events now."""
+    click.echo(f"Flushed {drain_outbox()} notification events.")
+
+@app.cli.command('compact-notifications')
+@click.option('--days', type=int, default=None, help='Keep read notifications this many days.')
+@migrated
+def compact_notifications_command(days):
+    """Delete old read notifications."""
+    days = app.config['NOTIFY_RETENTION_DAYS'] if days is None else days
+    removed = compact_notifications(get_db(), days)
+    click.echo(f"Removed {removed} read notifications older than {days} days.")
+
+# ---------- Bulk import / export ----------
+# Imports parse CSV or JSONL a row at a time and insert in chunks of
+# IMPORT_CHUNK_SIZE, one transaction per chunk, so memory stays flat however
+# large the file. Bad rows are skipped and reported; good rows still land.
+# Exports page through a table by id and stream each batch as it's read.
+app.config['IMPORT_CHUNK_SIZE'] = 1000
+app.config['IMPORT_MAX_ERRORS'] = 100   # errors listed in the report; all are counted
+app.config['EXPORT_BATCH_SIZE'] = 1000
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+PRODUCT_IMPORT_FIELDS = ('farmer_id', 'name', 'description', 'price', 'phone')
+
+# table -> columns, in export order (never password hashes)
+EXPORT_COLUMNS = {
+    'products': ('id', 'farmer_id', 'name', 'description', 'price', 'phone', 'image_filename', 'sold',
+                 'review_count', 'rating_sum', 'created_at'),
+    'orders': ('id', 'product_id', 'buyer_id', 'farmer_id', 'quantity', 'status', 'created_at'),
+    'users': ('id', 'role', 'name', 'email', 'phone', 'created_at'),
+}
+
+ImportReport = namedtuple('ImportReport', 'imported failed errors')
+
+def import_format(filename, mimetype):
+    """'csv' or 'jsonl', from ?format=, the file extension or the content type."""
+    fmt = (request.args.get('format') or '').lower()
+    if fmt:
+        return fmt if fmt in IMPORT_FORMATS else None
+    if (filename or '').lower().endswith(('.jsonl', '.ndjson')) or 'json' in (mimetype or ''):
+        return 'jsonl'
+    return 'csv'
+
+def read_import_rows(text, fmt):
+    """Yield (line number, dict or error message) from a text stream."""
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            if None in row:
+                yield reader.line_num, 'too many columns'
+            else:
+                yield reader.line_num, row
+        return
+    for line_no, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_no, f'invalid JSON: {e}'
+            continue
+        yield line_no, row if isinstance(row, dict) else 'expected a JSON object'
+
+def product_import_row(row, farmer_id, farmers, conn):
+    """Validate one import row into a products insert tuple; raises ValueError.
+
+    `farmer_id` is fixed for a farmer's own import; otherwise each row names
+    its farmer, checked once per id via the `farmers` cache.
+    """
+    unknown = set(row) - set(PRODUCT_IMPORT_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown field {sorted(unknown)[0]!r}")
+    name = str(row.get('name') or '').strip()
+    if not name:
+        raise ValueError('name is required')
+    try:
+        price = float(row.get('price'))
+    except (TypeError, ValueError):
+        raise ValueError('price must be a number') from None
+    if not 0 <= price < float('inf'):
+        raise ValueError('price must be zero or more')
+    if farmer_id is None:
+        try:
+            owner = int(row.get('farmer_id'))
+        except (TypeError, ValueError):
+            raise ValueError('farmer_id must be a farmer user id') from None
+        if owner not in farmers:
+            farmers[owner] = conn.execute("SELECT 1 FROM users WHERE id=? AND role='farmer'",
+                                          (owner,)).fetchone() is not None
+        if not farmers[owner]:
+            raise ValueError(f'no farmer with id {owner}')
+    elif row.get('farmer_id') not in (None, '', farmer_id, str(farmer_id)):
+        raise ValueError('farmer_id must be your own id')
+    else:
+        owner = farmer_id
+    description = str(row.get('description') or '').strip()
+    phone = str(row.get('phone') or '').strip()
+    return owner, name, description, price, phone
+
+def _insert_products(conn, batch):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("""INSERT INTO products (farmer_id, name, description, price, phone, created_at)
+                            VALUES (?,?,?,?,?,?)""", batch)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def import_products(conn, text, fmt, farmer_id=None):
+    """Import products from a CSV/JSONL text stream; returns an ImportReport."""
+    chunk_size = app.config['IMPORT_CHUNK_SIZE']
+    max_errors = app.config['IMPORT_MAX_ERRORS']
+    now = datetime.utcnow().isoformat()
+    farmers = {}
+    batch, errors = [], []
+    imported = failed = 0
+
+    def fail(line_no, message):
+        nonlocal failed
+        failed += 1
+        if len(errors) < max_errors:
+            errors.append({'line': line_no, 'error': message})
+
+    line_no = 0
+    try:
+        for line_no, row in read_import_rows(text, fmt):
+            if isinstance(row, str):
+                fail(line_no, row)
+                continue
+            try:
+                batch.append((*product_import_row(row, farmer_id, farmers, conn), now))
+            except ValueError as e:
+                fail(line_no, str(e))
+                continue
+            if len(batch) >= chunk_size:
+                _insert_products(conn, batch)
+                imported += len(batch)
+                batch = []
+    except (UnicodeDecodeError, csv.Error) as e:
+        # The rest of the stream can't be read; keep what parsed cleanly.
+        fail(line_no + 1, f'unreadable input, import stopped: {e}')
+    if batch:
+        _insert_products(conn, batch)
+        imported += len(batch)
+    if imported:
+        catalog_changed()
+    return ImportReport(imported, failed, errors)
+
+def export_rows(table, where='', params=()):
+    """Yield rows of `table`, read EXPORT_BATCH_SIZE at a time by id.
+
+    Uses its own pooled connection, held only while a batch is read, so it
+    can run from a streamed response after the request has ended.
+    """
+    columns = EXPORT_COLUMNS[table]
+    sql = (f"SELECT {', '.join(columns)} FROM {table} WHERE id > ? {where} ORDER BY id LIMIT ?")
+    size = app.config['EXPORT_BATCH_SIZE']
+    last_id = 0
+    while True:
+        conn = db_pool.acquire()
+        try:
+            rows = conn.execute(sql, (last_id, *params, size)).fetchall()
+        finally:
+            db_pool.release(conn)
+        yield from rows
+        if len(rows) < size:
+            return
+        last_id = rows[-1]['id']
+
+def export_lines(table, fmt, rows):
+    """Encode rows as CSV (with a header) or JSONL, one chunk per batch."""
+    if fmt == 'jsonl':
+        for row in rows:
+            yield json.dumps(dict(row), ensure_ascii=False) + '\n'
+        return
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS[table])
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % app.config['EXPORT_BATCH_SIZE'] == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def export_response(table, fmt, rows):
+    mimetype = 'application/x-ndjson' if fmt == 'jsonl' else 'text/csv'
+    return Response(export_lines(table, fmt, rows), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={table}.{fmt}'})
+
+@app.cli.command('import-products')
+@click.argument('source', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), default=None,
+              help='Defaults to jsonl for .jsonl/.ndjson files, else csv.')
+@click.option('--farmer', 'farmer_id', type=int, default=None,
+              help='Farmer owning every row; otherwise each row needs farmer_id.')
+@migrated
+def import_products_command(source, fmt, farmer_id):
+    """Bulk-import products from a CSV or JSONL file ('-' for stdin)."""
+    name = getattr(source, 'name', '')
+    fmt = fmt or ('jsonl' if name.lower().endswith(('.jsonl', '.ndjson')) else 'csv')
+    start = time.perf_counter()
+    report = import_products(get_db(), source, fmt, farmer_id)
+    for err in report.errors:
+        click.echo(f"line {err['line']}: {err['error']}", err=True)
+    click.echo(f"Imported {report.imported} products in {time.perf_counter() - start:.1f}s; "
+               f"{report.failed} rows rejected.")
+    if report.failed:
+        raise SystemExit(1)
+
+@app.cli.command('export')
+@click.argument('table', type=click.Choice(sorted(EXPORT_COLUMNS)))
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), default='csv')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-')
+@migrated
+def export_command(table, fmt, output):
+    """Stream a table as CSV or JSONL."""
+    for chunk in export_lines(table, fmt, export_rows(table)):
+        output.write(chunk)
+
+# ---------- Analytics ----------
+# Reports read only the daily rollups from migration 10 (farmer_daily_stats,
+# daily_stats), so their cost grows with the number of days asked for, not
+# with the number of orders. Days are UTC dates.
+app.config['ANALYTICS_DAYS'] = 30        # default report window
+app.config['ANALYTICS_MAX_DAYS'] = 366
+app.config['ANALYTICS_TOP_FARMERS'] = 10
+
+STATS_COLUMNS = ('listed', 'orders', 'revenue', 'sale_seconds', 'reviews', 'rating_sum')
+
+FARMER_STATS_SQL = """
+    SELECT day, listed, orders, revenue, sale_seconds, reviews, rating_sum
+    FROM farmer_daily_stats WHERE farmer_id=? AND day >= ? ORDER BY day
+"""
+DAILY_STATS_SQL = """
+    SELECT day, listed, orders, revenue, sale_seconds, reviews, rating_sum
+    FROM daily_stats WHERE day >= ? ORDER BY day
+"""
+# The unary + keeps the planner on the day index (a range over the window)
+# instead of walking the whole table in farmer order to group it.
+TOP_FARMERS_SQL = """
+    SELECT s.farmer_id, u.name, SUM(s.listed) AS listed, SUM(s.orders) AS orders, SUM(s.revenue) AS revenue,
+           SUM(s.sale_seconds) AS sale_seconds, SUM(s.reviews) AS reviews, SUM(s.rating_sum) AS rating_sum
+    FROM farmer_daily_stats s LEFT JOIN users u ON u.id = s.farmer_id
+    WHERE s.day >= ?
+    GROUP BY +s.farmer_id ORDER BY revenue DESC, orders DESC LIMIT ?
+"""
+HOT_QUERIES['analytics.farmer'] = (FARMER_STATS_SQL, (1, '2024-01-01'))
+HOT_QUERIES['analytics.daily'] = (DAILY_STATS_SQL, ('2024-01-01',))
+HOT_QUERIES['analytics.top_farmers'] = (TOP_FARMERS_SQL, ('2024-01-01', 10))
+
+def report_days():
+    """?days= clamped to 1..ANALYTICS_MAX_DAYS."""
+    days = request.args.get('days', app.config['ANALYTICS_DAYS'], type=int)
+    return min(max(days or 1, 1), app.config['ANALYTICS_MAX_DAYS'])
+
+def report_start(days):
+    return (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+
+def stats_summary(rows):
+    """Add up rollup rows and derive averages: rating, days from listing to
+    sale, and sell-through (orders per listing)."""
+    totals = dict.fromkeys(STATS_COLUMNS, 0)
+    for row in rows:
+        for col in STATS_COLUMNS:
+            totals[col] += row[col]
+    orders = totals['orders']
+    totals['revenue'] = round(totals['revenue'], 2)
+    totals['avg_rating'] = round(totals['rating_sum'] / totals['reviews'], 2) if totals['reviews'] else None
+    totals['avg_days_to_sale'] = round(totals.pop('sale_seconds') / orders / 86400, 1) if orders else None
+    totals['sell_through'] = round(orders / totals['listed'], 3) if totals['listed'] else None
+    del totals['rating_sum']
+    return totals
+
+def daily_json(row):
+    return {'day': row['day'], **stats_summary([row])}
+
+def farmer_report(conn, farmer_id, days):
+    rows = conn.execute(FARMER_STATS_SQL, (farmer_id, report_start(days))).fetchall()
+    return {'since': report_start(days), 'totals': stats_summary(rows), 'daily': [daily_json(r) for r in rows]}
+
+def marketplace_report(conn, days, top):
+    since = report_start(days)
+    rows = conn.execute(DAILY_STATS_SQL, (since,)).fetchall()
+    farmers = conn.execute(TOP_FARMERS_SQL, (since, top)).fetchall()
+    return {
+        'since': since, 'totals': stats_summary(rows), 'daily': [daily_json(r) for r in rows],
+        'top_farmers': [{'farmer_id': f['farmer_id'], 'name': f['name'], **stats_summary([f])} for f in farmers],
+    }
+
+@app.cli.command('rebuild-stats')
+@migrated
+def rebuild_stats_command():
+    """Recompute the daily rollups from products, orders and reviews."""
+    conn = get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    for sql in REBUILD_STATS_SQL:
+        conn.execute(sql)
+    conn.commit()
+    days = conn.execute("SELECT COUNT(*) FROM daily_stats").fetchone()[0]
+    click.echo(f"Rebuilt daily stats for {days} days.")
+
+# ---------- Maintenance ----------
+# Keeps the hot tables at working-set size and the data backed up:
+#   archive  - sold products whose orders are all older than ARCHIVE_AFTER_DAYS
+#              move, with those orders and their reviews, to an archive
+#              database; so do old orders of deleted products. Cart rows of
+#              deleted products or users and old read notifications go too.
+#   optimize - sampled ANALYZE, then PRAGMA optimize
+#   vacuum   - gives free pages back to the filesystem, a batch at a time
+#   backup   - consistent copies of app.db and the archive, through the
+#              SQLite backup API, while the app keeps serving
+# `flask maintenance` runs them now. With MAINTENANCE_WORKER on, every server
+# process also runs a thread that starts each task once its interval is up;
+# the maintenance_runs table makes sure only one process does. The daily
+# rollups keep counting archived sales, but rebuild-stats only sees what is
+# left in app.db.
+app.config['MAINTENANCE_WORKER'] = False
+app.config['MAINTENANCE_POLL_SECONDS'] = 60
+app.config['MAINTENANCE_INTERVALS'] = {'archive': 86400, 'optimize': 86400, 'vacuum': 86400, 'backup': 86400}
+app.config['MAINTENANCE_BATCH_SIZE'] = 500   # products archived per transaction
+app.config['ARCHIVE_DATABASE'] = None        # default: archive.db next to DATABASE
+app.config['ARCHIVE_AFTER_DAYS'] = 180
+app.config['ANALYZE_LIMIT'] = 1000           # index rows sampled per index by ANALYZE
+app.config['VACUUM_PAGES'] = 2000            # free pages released per transaction
+app.config['BACKUP_DIR'] = None              # default: backups/ next to DATABASE
+app.config['BACKUP_KEEP'] = 7                # newest backups kept per database
+
+maintenance_runs = Counter('maintenance_runs_total', 'Maintenance task runs, by task and outcome.',
+                           ('task', 'status'))
+maintenance_last_success = Gauge('maintenance_last_success_timestamp_seconds',
+                                 'Unix time the maintenance task last completed.', ('task',))
+
+ARCHIVED_TABLES = ('products', 'orders', 'reviews')
+
+# Walks old products by (created_at, id) so skipped unsold ones are read once.
+ARCHIVE_PRODUCTS_SQL = """
+    SELECT p.id, p.created_at FROM products p
+    WHERE p.created_at < :cutoff AND (p.created_at, p.id) > (:after_created, :after_id) AND p.sold = 1
+      AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.product_id = p.id AND o.created_at >= :cutoff)
+    ORDER BY p.created_at, p.id
+    LIMIT :limit
+"""
+ARCHIVE_ORDERS_SQL = """
+    SELECT o.id FROM orders o
+    WHERE o.created_at < :cutoff AND NOT EXISTS (SELECT 1 FROM products p WHERE p.id = o.product_id)
+    LIMIT :limit
+"""
+PURGE_CART_SQL = """
+    DELETE FROM cart
+    WHERE product_id NOT IN (SELECT id FROM products) OR buyer_id NOT IN (SELECT id FROM users)
+"""
+CLAIM_TASK_SQL = """
+    INSERT INTO maintenance_runs (task, started_at) VALUES (:task, :now)
+    ON CONFLICT (task) DO UPDATE SET started_at = excluded.started_at
+    WHERE maintenance_runs.started_at <= :due
+"""
+
+def beside_database(key, name):
+    """app.config[key], or `name` in the directory holding DATABASE."""
+    return app.config[key] or os.path.join(os.path.dirname(os.path.abspath(app.config['DATABASE'])), name)
+
+def attach_archive(conn):
+    """Attach the archive database as `archive`, creating or widening its
+    tables to match ours; returns the columns to copy per table."""
+    conn.execute("ATTACH DATABASE ? AS archive", (beside_database('ARCHIVE_DATABASE', 'archive.db'),))
+    conn.execute("PRAGMA archive.journal_mode=WAL")
+    columns = {}
+    for table in ARCHIVED_TABLES:
+        columns[table] = [r['name'] for r in conn.execute(f"PRAGMA main.table_info({table})")]
+        have = {r['name'] for r in conn.execute(f"PRAGMA archive.table_info({table})")}
+        if not have:
+            conn.execute(f"CREATE TABLE archive.{table} (id INTEGER PRIMARY KEY, archived_at TEXT NOT NULL)")
+            have = {'id', 'archived_at'}
+        for column in columns[table]:
+            if column not in have:
+                conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {column}")
+    return columns
+
+def _move_rows(conn, columns, table, key, ids, now):
+    """Copy the rows of `table` whose `key` is in `ids` to the archive, then
+    delete them here. Copies replace, so a batch interrupted between the two
+    databases is simply moved again."""
+    names = ', '.join(columns[table])
+    where = f"{key} IN (SELECT value FROM json_each(:ids))"
+    params = {'ids': json.dumps(ids), 'now': now}
+    conn.execute(f"INSERT OR REPLACE INTO archive.{table} ({names}, archived_at) "
+                 f"SELECT {names}, :now FROM main.{table} WHERE {where}", params)
+    return conn.execute(f"DELETE FROM main.{table} WHERE {where}", params).rowcount
+
+def archive_sales(conn, days=None):
+    """Move old sales to the archive and drop orphaned rows; returns the
+    number of rows moved or removed per table."""
+    days = app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    batch = app.config['MAINTENANCE_BATCH_SIZE']
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    now = datetime.utcnow().isoformat()
+    done = {'products': 0, 'orders': 0, 'reviews': 0, 'cart': 0}
+    columns = attach_archive(conn)
+    try:
+        after = ('', 0)
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(ARCHIVE_PRODUCTS_SQL, {'cutoff': cutoff, 'after_created': after[0],
+                                                           'after_id': after[1], 'limit': batch}).fetchall()
+                ids = [r['id'] for r in rows]
+                if ids:
+                    done['reviews'] += _move_rows(conn, columns, 'reviews', 'product_id', ids, now)
+                    done['orders'] += _move_rows(conn, columns, 'orders', 'product_id', ids, now)
+                    done['products'] += _move_rows(conn, columns, 'products', 'id', ids, now)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if len(rows) < batch:
+                break
+            after = (rows[-1]['created_at'], rows[-1]['id'])
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [r['id'] for r in conn.execute(ARCHIVE_ORDERS_SQL, {'cutoff': cutoff, 'limit': batch})]
+                if ids:
+                    done['orders'] += _move_rows(conn, columns, 'orders', 'id', ids, now)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if len(ids) < batch:
+                break
+    finally:
+        conn.execute("DETACH DATABASE archive")
+    done['cart'] = conn.execute(PURGE_CART_SQL).rowcount
+    conn.commit()
+    done['notifications'] = compact_notifications(conn, app.config['NOTIFY_RETENTION_DAYS'])
+    # Archived products let go of their images like deleted ones do.
+    done['uploads'] = collect_uploads(conn)
+    return done
+
+def optimize_database(conn):
+    """Refresh the planner statistics; returns how many indexes they cover."""
+    conn.execute(f"PRAGMA analysis_limit={int(app.config['ANALYZE_LIMIT'])}")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+    conn.commit()
+    return {'indexes': conn.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0]}
+
+def vacuum_database(conn, full=False):
+    """Shrink the file by the pages archiving and deletes freed up.
+
+    `full` rewrites the whole file with VACUUM, blocking writers until it
+    is done; it also switches databases created before incremental vacuum
+    over to it, after which the scheduled runs can do the rest.
+    """
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    before = conn.execute("PRAGMA page_count").fetchone()[0]
+    if full:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    elif conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return {'skipped': 'incremental vacuum is off; run `flask maintenance vacuum --full` once'}
+    else:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        while free:
+            # Each call is its own short write transaction; the rows must be
+            # read for SQLite to actually release the pages.
+            conn.execute(f"PRAGMA incremental_vacuum({int(app.config['VACUUM_PAGES'])})").fetchall()
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if remaining >= free:
+                break
+            free = remaining
+    # In WAL mode the file only shrinks once the change is checkpointed.
+    conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+    after = conn.execute("PRAGMA page_count").fetchone()[0]
+    return {'released_bytes': (before - after) * page_size,
+            'free_pages': conn.execute("PRAGMA freelist_count").fetchone()[0]}
+
+def backup_file(source, folder, prefix):
+    """Copy the database at `source` to folder/<prefix>-<UTC time>.db and
+    keep only the newest BACKUP_KEEP of them; returns the new file's path."""
+    os.makedirs(folder, exist_ok=True)
+    for path in glob.glob(os.path.join(folder, f'{prefix}-*.db.part')):
+        if os.path.getmtime(path) < time.time() - 3600:
+            os.remove(path)
+    final = os.path.join(folder, f"{prefix}-{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.db")
+    partial = final + '.part'
+    src = sqlite3.connect(source, timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000)
+    dst = sqlite3.connect(partial)
+    try:
+        # All pages in one step: the copy reads a single WAL snapshot, so it
+        # is consistent and never restarts, and writers are not held up.
+        src.backup(dst)
+        dst.execute("PRAGMA journal_mode=DELETE")
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    if check != 'ok':
+        os.remove(partial)
+        raise sqlite3.DatabaseError(f"backup of {source} failed quick_check: {check}")
+    os.replace(partial, final)
+    for old in sorted(glob.glob(os.path.join(folder, f'{prefix}-*.db')))[:-app.config['BACKUP_KEEP']]:
+        os.remove(old)
+    return final
+
+def backup_databases(conn, folder=None):
+    """Back up app.db and, once there is one, the archive."""
+    folder = folder or beside_database('BACKUP_DIR', 'backups')
+    done = {'app': backup_file(app.config['DATABASE'], folder, 'app')}
+    archive = beside_database('ARCHIVE_DATABASE', 'archive.db')
+    if os.path.exists(archive):
+        done['archive'] = backup_file(archive, folder, 'archive')
+    return done
+
+# task -> function(conn, **options) returning a JSON-able summary
+MAINTENANCE_TASKS = {
+    'archive': archive_sales,
+    'optimize': optimize_database,
+    'vacuum': vacuum_database,
+    'backup': backup_databases,
+}
+
+def run_maintenance(task, interval=None, **options):
+    """Run `task` on a connection of its own, unless some process started it
+    less than `interval` seconds ago. Returns its summary, or None if
+    skipped."""
+    conn = connect_db()
+    try:
+        now = datetime.utcnow()
+        due = now - timedelta(seconds=interval or 0)
+        claimed = conn.execute(CLAIM_TASK_SQL, {'task': task, 'now': now.isoformat(),
+                                                'due': due.isoformat()}).rowcount
+        conn.commit()
+        if not claimed:
+            return None
+        # Also what gets recorded if the task is interrupted (Ctrl-C, exit).
+        status, result = 'error', {'error': 'interrupted'}
+        try:
+            result = MAINTENANCE_TASKS[task](conn, **options)
+            status = 'ok'
+        except Exception as exc:
+            result = {'error': str(exc)}
+            raise
+        finally:
+            if status == 'error' and conn.in_transaction:
+                conn.rollback()
+            maintenance_runs.inc((task, status))
+            conn.execute("UPDATE maintenance_runs SET finished_at=?, status=?, result=? WHERE task=?",
+                         (datetime.utcnow().isoformat(), status, json.dumps(result), task))
+            conn.commit()
+        maintenance_last_success.set((task,), time.time())
+        return result
+    finally:
+        conn.close()
+
+_maintenance_lock = threading.Lock()
+_maintenance_thread = None
+
+def _maintenance_worker():
+    while not app_stopping.wait(app.config['MAINTENANCE_POLL_SECONDS']):
+        for task, interval in app.config['MAINTENANCE_INTERVALS'].items():
+            if app_stopping.is_set():
+                break
+            try:
+                result = run_maintenance(task, interval)
+            except Exception:
+                app.logger.exception("Maintenance task %s failed", task)
+            else:
+                if result is not None:
+                    app.logger.info("Maintenance task %s: %s", task, json.dumps(result))
+
+def start_maintenance_worker():
+    """Start this process's maintenance thread if it isn't running (e.g. after a fork)."""
+    global _maintenance_thread
+    with _maintenance_lock:
+        if _maintenance_thread is None or not _maintenance_thread.is_alive():
+            _maintenance_thread = threading.Thread(target=_maintenance_worker, name='maintenance', daemon=True)
+            _maintenance_thread.start()
+
+@app.cli.command('maintenance')
+@click.argument('tasks', nargs=-1, type=click.Choice(list(MAINTENANCE_TASKS)))
+@click.option('--days', type=int, default=None, help='Archive sales older than this many days.')
+@click.option('--full', is_flag=True, help='Vacuum by rewriting the whole file (blocks writers while it runs).')
+@click.option('--backup-dir', default=None, help='Write backups here.')
+@migrated
+def maintenance_command(tasks, days, full, backup_dir):
+    """Archive old sales, optimize, vacuum and back up (default: all, in that order)."""
+    options = {'archive': {'days': days}, 'vacuum': {'full': full}, 'backup': {'folder': backup_dir}}
+    for task in tasks or MAINTENANCE_TASKS:
+        click.echo(f"{task}: {json.dumps(run_maintenance(task, **options.get(task, {})))}")
+
 # ---------- Language (simple toggle) ----------
 TRANSLATIONS = {
     'en': {'title': 'Centralized Farmer System', 'farmer': 'Farmer', 'buyer': 'Buyer', 'admin':'Admin', 'logout':'Logout'},
@@ -132,23 +2439,379 @@ def login_user(user):
     session['role'] = user['role']
     session['name'] = user['name']
 
+# Logged-in user rows, so protected pages don't each re-read users. Entries
+# are dropped by forget_user() when a user changes in this process; the TTL
+# bounds how long other worker processes can serve a stale row.
+app.config['USER_CACHE_SIZE'] = 4096
+app.config['USER_CACHE_TTL'] = 60
+
+user_cache = TTLCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+_NO_USER = object()
+
+def load_user(uid):
+    user = user_cache.get(uid, _NO_USER)
+    if user is _NO_USER:
+        row = get_db().execute("SELECT id, role, name, email, phone, created_at FROM users WHERE id=?",
+                               (uid,)).fetchone()
+        user = dict(row) if row else None
+        user_cache.set(uid, user)
+    return user
+
+def forget_user(uid):
+    """Call after a user row is updated or deleted."""
+    user_cache.pop(uid)
+
 def current_user():
     uid = session.get('user_id')
     if not uid:
         return None
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id=?", (uid,))
-    user = cur.fetchone()
-    conn.close()
-    return user
+    if 'user' not in g:
+        g.user = load_user(uid)
+    return g.user
 
 def require_role(role):
     user = current_user()
-    return user and user['role'] == role
+    # Normal users
+    if user and user['role'] == role:
+        return True
+
+    # Special case: permanent developer admin
+    if session.get('role') == 'admin' and session.get('is_developer_admin'):
+        return True
+
+    return False
+
+# Where each role logs in, and what to tell a visitor who isn't logged in.
+ROLE_LOGIN = {
+    'farmer': ('farmer_login', 'Please login as farmer.', 'warning'),
+    'buyer': ('buyer_login', 'Please login as buyer.', 'warning'),
+    'admin': ('admin_login', 'Admin only.', 'danger'),
+}
+
+def role_required(role, message=None):
+    """Redirect to the role's login page unless the session holds `role`."""
+    endpoint, default_message, category = ROLE_LOGIN[role]
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not require_role(role):
+                flash(message or default_message, category)
+                return redirect(url_for(endpoint))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ---------- Rate limiting ----------
+# Token buckets: a bucket holds up to `burst` tokens and refills at
+# burst/period tokens a second; each attempt spends one. Logins are limited
+# per client IP and per account, so neither one address nor a crowd aimed at
+# one account can keep the CPU busy hashing passwords. The "memory" store is
+# per process; "sqlite" shares buckets between serve.py's worker processes
+# through a small side database (not the app's, to stay off its write lock).
+app.config['RATE_LIMIT_ENABLED'] = True
+app.config['RATE_LIMIT_STORE'] = 'memory'      # or 'sqlite'
+app.config['RATE_LIMIT_DATABASE'] = None       # sqlite store file; default: DATABASE + '-ratelimit'
+app.config['RATE_LIMITS'] = {                  # name: (burst, period in seconds)
+    'login_ip': (20, 60),
+    'login_account': (5, 300),                 # failed logins only
+    'register_ip': (5, 600),
+    'suggest_ip': (40, 10),
+}
+# Password hashes allowed to run at once in a process; the rest wait this
+# long for a slot and then get a 503, rather than queueing without bound.
+app.config['PASSWORD_HASH_CONCURRENCY'] = 2
+app.config['PASSWORD_HASH_WAIT'] = 2
+
+rate_limit_checks = Counter('rate_limit_checks_total', 'Requests checked against a rate limit.', ('limit',))
+rate_limited = Counter('rate_limited_total', 'Requests refused by a rate limit.', ('limit',))
+password_hash_busy = Counter('password_hash_busy_total', 'Logins and registrations refused because '
+                             'every password hashing slot was taken.', ())
+
+class MemoryBucketStore:
+    """Buckets in a dict. Past `maxsize` keys the least recently used is
+    forgotten, which only means it starts full again."""
+    def __init__(self, maxsize=100_000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate, cost, now):
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / rate
+
+class SQLiteBucketStore:
+    """Buckets in a SQLite file shared by every process on the host."""
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._takes = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # One connection per process; a forked child opens its own.
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")   # a bucket lost in a crash just starts full
+            conn.execute("""CREATE TABLE IF NOT EXISTS buckets (
+                                key TEXT PRIMARY KEY, tokens REAL NOT NULL,
+                                updated REAL NOT NULL, full_at REAL NOT NULL) WITHOUT ROWID""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_buckets_full_at ON buckets(full_at)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def take(self, key, burst, rate, cost, now):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key=?", (key,)).fetchone()
+                tokens, updated = row or (burst, now)
+                tokens = min(burst, tokens + (now - updated) * rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= cost
+                conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated, full_at) VALUES (?,?,?,?)",
+                             (key, tokens, now, now + (burst - tokens) / rate))
+                self._takes += 1
+                if self._takes % self.PRUNE_EVERY == 0:
+                    # A full bucket is the same as no bucket.
+                    conn.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return 0 if allowed else (1 - tokens) / rate
+
+class RateLimiter:
+    """Looks up limits by name in RATE_LIMITS and keeps the configured store."""
+    def __init__(self):
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def store(self):
+        kind = app.config['RATE_LIMIT_STORE']
+        if kind == 'sqlite':
+            key = (kind, app.config['RATE_LIMIT_DATABASE'] or app.config['DATABASE'] + '-ratelimit')
+        else:
+            key = (kind,)
+        with self._lock:
+            store = self._stores.get(key)
+            if store is None:
+                store = self._stores[key] = SQLiteBucketStore(key[1]) if kind == 'sqlite' else MemoryBucketStore()
+        return store
+
+    def hit(self, name, key, cost=1):
+        """Spend `cost` tokens from `key`'s bucket under limit `name`.
+
+        Returns 0 when the attempt may go ahead, otherwise the seconds until
+        it may. cost=0 just checks without spending.
+        """
+        if not app.config['RATE_LIMIT_ENABLED']:
+            return 0
+        burst, period = app.config['RATE_LIMITS'][name]
+        rate_limit_checks.inc((name,))
+        wait = self.store().take(f'{name}:{key}', burst, burst / period, cost, time.time())
+        if wait:
+            rate_limited.inc((name,))
+        return wait
+
+rate_limiter = RateLimiter()
+
+def client_ip():
+    return request.remote_addr or 'unknown'
+
+class HashingBusy(Exception):
+    """Every password hashing slot in this process stayed taken."""
+
+_hash_slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_CONCURRENCY'])
+
+def _hashing(fn, *args):
+    if not _hash_slots.acquire(timeout=app.config['PASSWORD_HASH_WAIT']):
+        password_hash_busy.inc(())
+        raise HashingBusy
+    try:
+        return fn(*args)
+    finally:
+        _hash_slots.release()
+
+def hash_password(password):
+    return _hashing(generate_password_hash, password)
+
+def verify_password(password_hash, password):
+    return _hashing(check_password_hash, password_hash, password)
+
+# The form each login/register endpoint shows, for answering a refused attempt.
+AUTH_FORMS = {
+    'farmer_login': ('farmer_login.html', {'mode': 'login'}),
+    'farmer_register': ('farmer_login.html', {'mode': 'register'}),
+    'buyer_login': ('buyer_login.html', {'mode': 'login'}),
+    'buyer_register': ('buyer_login.html', {'mode': 'register'}),
+    'admin_login': ('admin_login.html', {}),
+}
+
+def refuse_auth_form(message, wait, status=429):
+    """Show the form again with `message` and a Retry-After of `wait` seconds."""
+    template, context = AUTH_FORMS[request.endpoint]
+    flash(message, 'danger')
+    resp = make_response(render_template(template, **context), status)
+    resp.retry_after = max(1, math.ceil(wait))
+    return resp
+
+def too_many_attempts(wait):
+    return refuse_auth_form(f'Too many attempts. Please try again in {max(1, math.ceil(wait))} seconds.', wait)
+
+def login_throttled(role, identifier):
+    """Seconds to wait before this IP may try logging in to `identifier`."""
+    return (rate_limiter.hit('login_ip', client_ip())
+            or rate_limiter.hit('login_account', f'{role}:{identifier}', cost=0))
+
+def login_failed(role, identifier):
+    rate_limiter.hit('login_account', f'{role}:{identifier}')
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(exc):
+    return refuse_auth_form('The server is busy. Please try again in a moment.', 1, 503)
+
+# ---------- Pagination ----------
+# Listings page by keyset: a cursor holds the sort key of the last row shown,
+# so every page is an index range scan of PAGE_SIZE + 1 rows however deep the
+# reader scrolls.
+app.config['PAGE_SIZE'] = 24
+app.config['MAX_PAGE_SIZE'] = 100
+
+def encode_cursor(*key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Sort key from a cursor token; None (first page) if missing or garbled."""
+    if not token:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    # Only values our own cursors hold: a sort value and a row id.
+    if not (isinstance(key, list) and len(key) == 2):
+        return None
+    value, row_id = key
+    if (isinstance(value, bool) or not isinstance(value, (str, int, float))
+            or isinstance(row_id, bool) or not isinstance(row_id, int)):
+        return None
+    return key
+
+def page_size():
+    size = request.args.get('limit', type=int) or app.config['PAGE_SIZE']
+    return max(1, min(size, app.config['MAX_PAGE_SIZE']))
+
+def fetch_page(cur, sql, params, size, key):
+    """Run a query selecting up to size + 1 rows; return (rows, next cursor)."""
+    return paginate(cur.execute(sql, params).fetchall(), size, key)
+
+def paginate(rows, size, key):
+    """(the first `size` rows, cursor for the next page or None)."""
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    return rows, encode_cursor(*key(rows[-1]))
+
+def newest_first(row):
+    return row['created_at'], row['id']
+
+# Optional narrowing of listings and search results: query parameter ->
+# (type, SQL condition on products p, the same test on a CatalogProduct).
+LISTING_FILTERS = {
+    'farmer': (int, 'p.farmer_id = :farmer', lambda p, v: p.farmer_id == v),
+    'min_price': (float, 'p.price >= :min_price', lambda p, v: p.price >= v),
+    'max_price': (float, 'p.price <= :max_price', lambda p, v: p.price <= v),
+}
+
+def listing_filters():
+    """The LISTING_FILTERS given in the query string, by name."""
+    filters = {}
+    for name, (kind, _, _) in LISTING_FILTERS.items():
+        value = request.args.get(name, type=kind)
+        if value is not None:
+            filters[name] = value
+    return filters
+
+def filter_sql(filters):
+    return ''.join(f' AND {LISTING_FILTERS[name][1]}' for name in filters)
+
+PRODUCT_LISTING_SQL = """
+    SELECT p.*, u.name AS farmer_name
+    FROM products p
+    JOIN users u ON p.farmer_id = u.id
+    WHERE p.sold = 0 {after} {filters}
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT :limit
+"""
+
+def list_products(cursor, size, filters=None):
+    """One page of unsold products, newest first."""
+    after, filters = decode_cursor(cursor), filters or {}
+    if app.config['CATALOG_SNAPSHOT']:
+        return paginate(catalog_snapshot.page(after, size, filters), size, newest_first)
+    sql = PRODUCT_LISTING_SQL.format(after='AND (p.created_at, p.id) < (:after_created, :after_id)' if after else '',
+                                     filters=filter_sql(filters))
+    params = {**filters, 'limit': size + 1}
+    if after:
+        params.update(after_created=after[0], after_id=after[1])
+    return fetch_page(get_db().cursor(), sql, params, size, newest_first)
+
+HOT_QUERIES['product_listing'] = (
+    PRODUCT_LISTING_SQL.format(after='AND (p.created_at, p.id) < (:after_created, :after_id)', filters=''),
+    {'after_created': '2025-01-01', 'after_id': 1, 'limit': 25})
+HOT_QUERIES['product_listing.farmer'] = (
+    PRODUCT_LISTING_SQL.format(after='', filters=filter_sql({'farmer': 1})), {'farmer': 1, 'limit': 25})
+
+def product_json(p):
+    variants = image_variants_filter(p) or {}
+    # The largest variant is the whole image; the original only until it exists.
+    image = variants['jpg'][-1][1] if variants.get('jpg') else p['image_filename']
+    return {
+        'id': p['id'], 'name': p['name'], 'description': p['description'], 'price': p['price'],
+        'phone': p['phone'], 'farmer_name': p['farmer_name'], 'created_at': p['created_at'],
+        'image_url': url_for('uploaded_file', filename=image) if image else None,
+        'image_srcset': {fmt: srcset_filter(v) for fmt, v in variants.items()},
+        'review_count': p['review_count'],
+        'avg_rating': p['rating_sum'] / p['review_count'] if p['review_count'] else 0,
+    }
+
+def product_tiles(load, *key):
+    """(rendered tiles, next cursor) for one listing page. `load` returns
+    (rows, next cursor); its result is rendered once per catalog version."""
+    def render():
+        rows, cursor = load()
+        return Markup(render_template('_product_tiles.html', products=rows).strip()), cursor
+    return cached_fragment(('product_tiles', *key), render)
+
+def paged_page(template, tiles, next_url, **context):
+    """Render a listing page, or just its tiles when the infinite-scroll
+    script asks for ?partial=1. The next page URL travels in X-Next-Page."""
+    if request.args.get('partial'):
+        resp = make_response(tiles)
+    else:
+        resp = make_response(render_template(template, tiles=tiles, next_url=next_url, **context))
+    if next_url:
+        resp.headers['X-Next-Page'] = next_url
+    return resp
 
 # ---------- Routes ----------
 @app.route('/')
+@catalog_conditional
 def index():
     return render_template('index.html')
 
@@ -156,6 +2819,9 @@ def index():
 @app.route('/farmer/register', methods=['GET','POST'])
 def farmer_register():
     if request.method == 'POST':
+        wait = rate_limiter.hit('register_ip', client_ip())
+        if wait:
+            return too_many_attempts(wait)
         name = request.form['name'].strip()
         email = request.form.get('email','').strip().lower()
         phone = request.form.get('phone','').strip()
@@ -163,14 +2829,12 @@ def farmer_register():
         conn = get_db(); cur = conn.cursor()
         try:
             cur.execute("""INSERT INTO users (role, name, email, phone, password_hash, created_at)
-                           VALUES (?,?,?,?,?,?)""",                        ('farmer', name, email or None, phone, generate_password_hash(password), datetime.utcnow().isoformat()))
+                           VALUES (?,?,?,?,?,?)""",                        ('farmer', name, email or None, phone, hash_password(password), datetime.utcnow().isoformat()))
             conn.commit()
             flash('Farmer registered! Please login.', 'success')
             return redirect(url_for('farmer_login'))
         except sqlite3.IntegrityError:
             flash('Email already in use.', 'danger')
-        finally:
-            conn.close()
     return render_template('farmer_login.html', mode='register')
 
 @app.route('/farmer/login', methods=['GET','POST'])
@@ -178,16 +2842,19 @@ def farmer_login():
     if request.method == 'POST':
         email_or_phone = request.form['email_or_phone'].strip().lower()
         password = request.form['password']
+        wait = login_throttled('farmer', email_or_phone)
+        if wait:
+            return too_many_attempts(wait)
         conn = get_db(); cur = conn.cursor()
         if '@' in email_or_phone:
             cur.execute("SELECT * FROM users WHERE role='farmer' AND email=?", (email_or_phone,))
         else:
             cur.execute("SELECT * FROM users WHERE role='farmer' AND phone=?", (email_or_phone,))
         user = cur.fetchone()
-        conn.close()
-        if user and check_password_hash(user['password_hash'], password):
+        if user and verify_password(user['password_hash'], password):
             login_user(user)
             return redirect(url_for('farmer_dashboard'))
+        login_failed('farmer', email_or_phone)
         flash('Invalid credentials', 'danger')
     return render_template('farmer_login.html', mode='login')
 
@@ -197,75 +2864,122 @@ def farmer_logout():
     return redirect(url_for('index'))
 
 @app.route('/farmer/dashboard')
+@role_required('farmer')
 def farmer_dashboard():
-    if not require_role('farmer'):
-        flash('Please login as farmer.', 'warning')
-        return redirect(url_for('farmer_login'))
     user = current_user()
     conn = get_db(); cur = conn.cursor()
     cur.execute("SELECT * FROM products WHERE farmer_id=? ORDER BY created_at DESC", (user['id'],))
     my_products = cur.fetchall()
-    cur.execute("SELECT * FROM notifications WHERE user_id=? ORDER BY created_at DESC LIMIT 20", (user['id'],))
-    notes = cur.fetchall()
-    conn.close()
-    return render_template('farmer_dashboard.html', products=my_products, notes=notes)
+    report = farmer_report(conn, user['id'], app.config['ANALYTICS_DAYS'])
+    return render_template('farmer_dashboard.html', products=my_products, report=report)
 @app.route('/farmer/add', methods=['GET','POST'])
+@role_required('farmer')
 def farmer_add():
-    if not require_role('farmer'):
-        flash('Please login as farmer.', 'warning')
-        return redirect(url_for('farmer_login'))
-
     if request.method == 'POST':
         name = request.form['name'].strip()
         price = float(request.form['price'])
         description = request.form.get('description','').strip()
         phone = request.form.get('phone','').strip()
 
-        filename = None
+        staged = None
+        # Camera photos arrive beforehand through /farmer/upload; the form
+        # only carries the returned token.
+        camera_upload = request.form.get('camera_upload', '').strip()
+        try:
+            # 1️⃣ Handle file upload
+            file = request.files.get('image')
+            if file and allowed_file(file.filename) and not camera_upload:
+                staged = stage_upload(file.stream)
 
-        # 1️⃣ Handle file upload
-        file = request.files.get('image')
-        if file and allowed_file(file.filename):
-            from werkzeug.utils import secure_filename
-            filename = secure_filename(f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}")
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-            file.save(save_path)
-
-        # 2️⃣ Handle camera image (base64)
-        camera_data = request.form.get('camera_image')
-        if camera_data:
-            # Remove 'data:image/png;base64,' prefix
-            header, encoded = camera_data.split(",", 1)
-            data = base64.b64decode(encoded)
-            filename = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_camera.png"
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-            with open(save_path, "wb") as f:
-                f.write(data)
+            # 2️⃣ Handle camera image (base64, from pages cached before /farmer/upload)
+            camera_data = request.form.get('camera_image')
+            if camera_data and not camera_upload:
+                discard_upload(staged)
+                staged = stage_data_url(camera_data)
+        except UploadTooLarge:
+            discard_upload(staged)
+            flash('That image is too large.', 'danger')
+            return render_template('add_product.html')
+        except ValueError:
+            discard_upload(staged)
+            flash('Please upload a PNG, JPEG, GIF or WebP image.', 'danger')
+            return render_template('add_product.html')
 
         # Insert product into DB
         conn = get_db()
         cur = conn.cursor()
-        cur.execute("""INSERT INTO products (farmer_id, name, description, price, phone, image_filename, created_at)
-                       VALUES (?,?,?,?,?,?,?)""",
-                    (session['user_id'], name, description, price, phone, filename, datetime.utcnow().isoformat()))
-        conn.commit()
-        conn.close()
+        filename = variants = None
+        created = False
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            if camera_upload:
+                row = cur.execute("SELECT filename, variants FROM uploads WHERE hash=?", (camera_upload,)).fetchone()
+                if row is None:
+                    conn.rollback()
+                    flash('The camera photo expired, please take it again.', 'danger')
+                    return render_template('add_product.html')
+                filename, variants = row['filename'], row['variants']
+            elif staged:
+                filename, variants, created = commit_upload(conn, staged)
+            cur.execute("""INSERT INTO products (farmer_id, name, description, price, phone, image_filename, image_variants, created_at)
+                           VALUES (?,?,?,?,?,?,?,?)""",
+                        (session['user_id'], name, description, price, phone, filename, variants, datetime.utcnow().isoformat()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            discard_upload(staged)
+            raise
+        if created:
+            queue_image_processing(filename)
 
+        catalog_changed()
         flash('Product added!', 'success')
         return redirect(url_for('farmer_dashboard'))
 
     return render_template('add_product.html')
 
+@app.route('/farmer/upload', methods=['POST'])
+def farmer_upload():
+    """Store one image sent as multipart `image` or as a raw image/* body,
+    streamed to disk in chunks. Returns a token for farmer_add."""
+    if not require_role('farmer'):
+        return jsonify({'error': 'Please login as farmer.'}), 401
+    if request.content_length and request.content_length > app.config['UPLOAD_MAX_BYTES'] + 64 * 1024:
+        return jsonify({'error': 'Image is larger than the upload limit'}), 413
+    if request.mimetype == 'multipart/form-data':
+        file = request.files.get('image')
+        if not file:
+            return jsonify({'error': 'No image field in upload'}), 400
+        stream = file.stream
+    else:
+        stream = request.stream
+    try:
+        staged = stage_upload(stream)
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 415
+    conn = get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        filename, variants, created = commit_upload(conn, staged)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        discard_upload(staged)
+        raise
+    if created:
+        queue_image_processing(filename)
+    return jsonify({'upload': staged.digest, 'url': url_for('uploaded_file', filename=filename)}), 201
+
 @app.route('/farmer/delete/<int:pid>')
+@role_required('farmer')
 def farmer_delete(pid):
-    if not require_role('farmer'):
-        flash('Please login as farmer.', 'warning')
-        return redirect(url_for('farmer_login'))
     conn = get_db(); cur = conn.cursor()
     cur.execute("DELETE FROM products WHERE id=? AND farmer_id=?", (pid, session['user_id']))
-    conn.commit(); conn.close()
+    conn.commit()
+    collect_uploads(conn)
+    catalog_changed()
     flash('Product deleted.', 'info')
     return redirect(url_for('farmer_dashboard'))
 
@@ -273,6 +2987,9 @@ def farmer_delete(pid):
 @app.route('/buyer/register', methods=['GET','POST'])
 def buyer_register():
     if request.method == 'POST':
+        wait = rate_limiter.hit('register_ip', client_ip())
+        if wait:
+            return too_many_attempts(wait)
         name = request.form['name'].strip()
         email = request.form.get('email','').strip().lower()
         phone = request.form.get('phone','').strip()
@@ -280,14 +2997,12 @@ def buyer_register():
         conn = get_db(); cur = conn.cursor()
         try:
             cur.execute("""INSERT INTO users (role, name, email, phone, password_hash, created_at)
-                           VALUES (?,?,?,?,?,?)""",                        ('buyer', name, email or None, phone, generate_password_hash(password), datetime.utcnow().isoformat()))
+                           VALUES (?,?,?,?,?,?)""",                        ('buyer', name, email or None, phone, hash_password(password), datetime.utcnow().isoformat()))
             conn.commit()
             flash('Buyer registered! Please login.', 'success')
             return redirect(url_for('buyer_login'))
         except sqlite3.IntegrityError:
             flash('Email already in use.', 'danger')
-        finally:
-            conn.close()
     return render_template('buyer_login.html', mode='register')
 
 @app.route('/buyer/login', methods=['GET','POST'])
@@ -295,16 +3010,19 @@ def buyer_login():
     if request.method == 'POST':
         email_or_phone = request.form['email_or_phone'].strip().lower()
         password = request.form['password']
+        wait = login_throttled('buyer', email_or_phone)
+        if wait:
+            return too_many_attempts(wait)
         conn = get_db(); cur = conn.cursor()
         if '@' in email_or_phone:
             cur.execute("SELECT * FROM users WHERE role='buyer' AND email=?", (email_or_phone,))
         else:
             cur.execute("SELECT * FROM users WHERE role='buyer' AND phone=?", (email_or_phone,))
         user = cur.fetchone()
-        conn.close()
-        if user and check_password_hash(user['password_hash'], password):
+        if user and verify_password(user['password_hash'], password):
             login_user(user)
             return redirect(url_for('buyer_dashboard'))
+        login_failed('buyer', email_or_phone)
         flash('Invalid credentials', 'danger')
     return render_template('buyer_login.html', mode='login')
 
@@ -314,24 +3032,14 @@ def buyer_logout():
     return redirect(url_for('index'))
 
 @app.route('/buyer/dashboard')
+@role_required('buyer')
+@catalog_conditional
 def buyer_dashboard():
-    if not require_role('buyer'):
-        flash('Please login as buyer.', 'warning')
-        return redirect(url_for('buyer_login'))
-    uid = session['user_id']
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("""
-        SELECT p.*, u.name AS farmer_name 
-        FROM products p 
-        JOIN users u ON p.farmer_id = u.id
-        WHERE p.sold = 0
-        ORDER BY p.created_at DESC
-    """)
-    products = cur.fetchall()
-    cur.execute("SELECT * FROM notifications WHERE user_id=? ORDER BY created_at DESC LIMIT 20", (uid,))
-    notes = cur.fetchall()
-    conn.close()
-    return render_template('buyer_dashboard.html', products=products, notes=notes)
+    cursor, size, filters = request.args.get('cursor'), page_size(), listing_filters()
+    tiles, cursor = product_tiles(lambda: list_products(cursor, size, filters),
+                                  'listing', cursor, size, *sorted(filters.items()))
+    next_url = url_for('buyer_dashboard', cursor=cursor, **filters) if cursor else None
+    return paged_page('buyer_dashboard.html', tiles, next_url)
 
 # ---- Search & Suggest (English + simple Kannada synonyms) ----
 KANNADA_MAP = {
@@ -348,135 +3056,544 @@ KANNADA_MAP = {
     "hannu": "fruit"
 }
 
+app.config['SEARCH_RATING_WEIGHT'] = 0.5  # avg-rating stars worth this much bm25
+
+def search_terms(q):
+    """Lower-cased query words, with two-word KANNADA_MAP keys kept together."""
+    words = [w for w in q.lower().split() if any(ch.isalnum() for ch in w)]
+    terms, i = [], 0
+    while i < len(words):
+        pair = ' '.join(words[i:i + 2])
+        if i + 1 < len(words) and pair in KANNADA_MAP:
+            terms.append(pair); i += 2
+        else:
+            terms.append(words[i]); i += 1
+    return terms
+
+def term_alternatives(q):
+    """Per query term, the spellings that may match it: as typed, or its
+    English equivalent from KANNADA_MAP."""
+    return [[term] + ([KANNADA_MAP[term]] if term in KANNADA_MAP else []) for term in search_terms(q)]
+
+def fts_query(q, column=None):
+    """Build an FTS5 MATCH expression: every term must match as a prefix,
+    either as typed or as its English equivalent from KANNADA_MAP."""
+    groups = []
+    for alternatives in term_alternatives(q):
+        phrases = ['"{}" *'.format(a.replace('"', '""')) for a in alternatives]
+        groups.append('(' + ' OR '.join(phrases) + ')')
+    if not groups:
+        return None
+    expr = ' AND '.join(groups)
+    return f'{column} : ({expr})' if column else expr
+
+SUGGEST_SQL = """
+    SELECT p.name, SUM(p.review_count) AS review_count,
+           COALESCE(SUM(p.rating_sum) * 1.0 / NULLIF(SUM(p.review_count), 0), 0) AS avg_rating
+    FROM products_fts
+    JOIN products p ON p.id = products_fts.rowid
+    WHERE products_fts MATCH ? AND p.sold = 0
+    GROUP BY p.name
+    ORDER BY MIN(products_fts.rank) - ? * avg_rating, review_count DESC
+    LIMIT 5
+"""
+
+# Pages by (score, id): every match is still scored, but only one page of
+# rows is joined, returned and rendered.
+SEARCH_SQL = """
+    SELECT * FROM (
+        SELECT p.*, u.name AS farmer_name,
+               products_fts.rank - :weight * COALESCE(p.rating_sum * 1.0 / NULLIF(p.review_count, 0), 0) AS score
+        FROM products_fts
+        JOIN products p ON p.id = products_fts.rowid
+        JOIN users u ON p.farmer_id = u.id
+        WHERE products_fts MATCH :match AND p.sold = 0 {filters}
+    )
+    WHERE :after_id IS NULL OR (score, id) > (:after_score, :after_id)
+    ORDER BY score, id
+    LIMIT :limit
+"""
+
+def search_products(match, cursor, size, filters=None):
+    after, filters = decode_cursor(cursor) or (None, None), filters or {}
+    params = {**filters, 'match': match, 'weight': app.config['SEARCH_RATING_WEIGHT'],
+              'after_score': after[0], 'after_id': after[1], 'limit': size + 1}
+    return fetch_page(get_db().cursor(), SEARCH_SQL.format(filters=filter_sql(filters)), params, size,
+                      lambda r: (r['score'], r['id']))
+
+HOT_QUERIES['api_suggest'] = (SUGGEST_SQL, ('name : ("akki" * OR "rice" *)', 0.5))
+HOT_QUERIES['search'] = (SEARCH_SQL.format(filters=''), {'match': '("akki" * OR "rice" *)', 'weight': 0.5,
+                                      'after_score': None, 'after_id': None, 'limit': 25})
+
 @app.route('/api/suggest')
 def api_suggest():
-    q = request.args.get('q','').strip().lower()
-    if not q:
+    wait = rate_limiter.hit('suggest_ip', client_ip())
+    if wait:
+        resp = jsonify(error='too many requests')
+        resp.status_code = 429
+        resp.retry_after = max(1, math.ceil(wait))
+        return resp
+    q = request.args.get('q','')
+    match = fts_query(q, column='name')
+    if not match:
         return jsonify([])
-    qx = KANNADA_MAP.get(q, q)
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("""
-        SELECT name, COUNT(reviews.id) AS review_count, 
-               COALESCE(AVG(reviews.rating),0) AS avg_rating
-        FROM products
-        LEFT JOIN reviews ON products.id = reviews.product_id
-        WHERE sold=0 AND LOWER(name) LIKE ?
-        GROUP BY name
-        ORDER BY avg_rating DESC, review_count DESC
-        LIMIT 5
-    """, (f'%{qx}%',))
-    results = [{'name': r['name'], 'avg_rating': r['avg_rating'], 'review_count': r['review_count']} for r in cur.fetchall()]
-    conn.close()
-    return jsonify(results)
+    # The match expression is the normalized query: case, spacing and the
+    # Kannada synonyms are already folded in. The catalog version moves on
+    # whenever any process changes a product, so no process answers from
+    # entries that predate the change.
+    key = (catalog_version()[0], match)
+    cached = suggest_cache.get(key)
+    if cached is None:
+        if app.config['CATALOG_SNAPSHOT']:
+            results = catalog_snapshot.suggest(term_alternatives(q))
+        else:
+            conn = get_db(); cur = conn.cursor()
+            cur.execute(SUGGEST_SQL, (match, app.config['SEARCH_RATING_WEIGHT']))
+            results = [{'name': r['name'], 'avg_rating': r['avg_rating'], 'review_count': r['review_count']} for r in cur.fetchall()]
+        body = json.dumps(results, ensure_ascii=False).encode('utf-8')
+        cached = (body, hashlib.sha1(body).hexdigest())
+        suggest_cache.set(key, cached)
+    body, etag = cached
+    resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config['SUGGEST_MAX_AGE']
+    return resp.make_conditional(request)
 
 @app.route('/search')
+@catalog_conditional
 def search():
     q = request.args.get('q','').strip().lower()
-    qx = KANNADA_MAP.get(q, q)
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("""
-        SELECT p.*, u.name AS farmer_name
-        FROM products p
-        JOIN users u ON p.farmer_id = u.id
-        LEFT JOIN reviews r ON p.id = r.product_id
-        WHERE p.sold=0 AND (LOWER(p.name) LIKE ? OR LOWER(p.description) LIKE ?)
-        GROUP BY p.id
-        ORDER BY COALESCE(AVG(r.rating),0) DESC
-    """, (f'%{qx}%', f'%{qx}%',))
-    rows = cur.fetchall()
-    conn.close()
-    return render_template('buyer_dashboard.html', products=rows, notes=[], query=q)
+    match = fts_query(q)
+    cursor, size, filters = request.args.get('cursor'), page_size(), listing_filters()
+    if match:
+        tiles, cursor = product_tiles(lambda: search_products(match, cursor, size, filters),
+                                      'search', match, cursor, size, *sorted(filters.items()))
+    else:
+        tiles, cursor = product_tiles(lambda: list_products(cursor, size, filters),
+                                      'listing', cursor, size, *sorted(filters.items()))
+    next_url = url_for('search', q=q, cursor=cursor, **filters) if cursor else None
+    return paged_page('buyer_dashboard.html', tiles, next_url, query=q)
+
+@app.route('/api/products')
+@catalog_conditional
+def api_products():
+    """JSON listing of unsold products; pass ?q= to search, ?cursor= to page
+    and any of ?farmer=, ?min_price=, ?max_price= to narrow it down."""
+    match = fts_query(request.args.get('q',''))
+    cursor, filters = request.args.get('cursor'), listing_filters()
+    if match:
+        rows, cursor = search_products(match, cursor, page_size(), filters)
+    else:
+        rows, cursor = list_products(cursor, page_size(), filters)
+    return jsonify({'items': [product_json(p) for p in rows], 'next_cursor': cursor})
 
 # ---- Cart & Checkout ----
+# One row per (buyer, product), so adding is a single idempotent upsert. The
+# cart is capped, which keeps the badge summary a bounded index range.
+app.config['CART_MAX_ITEMS'] = 100
+app.config['CART_MAX_QUANTITY'] = 99
+
+CART_ITEMS_SQL = """
+    SELECT c.id AS cart_id, c.quantity, p.*, u.name AS farmer_name
+    FROM cart c
+    JOIN products p ON c.product_id = p.id
+    JOIN users u ON p.farmer_id = u.id
+    WHERE c.buyer_id=?
+    ORDER BY c.id
+"""
+# Products that are sold or gone count as unavailable, not towards the total.
+CART_SUMMARY_SQL = """
+    SELECT COUNT(*) AS lines,
+           COALESCE(SUM(CASE WHEN p.sold = 0 THEN c.quantity END), 0) AS quantity,
+           COALESCE(SUM(CASE WHEN p.sold = 0 THEN c.quantity * p.price END), 0) AS total,
+           COALESCE(SUM(p.sold IS NOT 0), 0) AS unavailable
+    FROM cart c LEFT JOIN products p ON p.id = c.product_id
+    WHERE c.buyer_id=?
+"""
+# Adds only products still for sale; on a repeat, `quantity` says what the
+# row keeps ("excluded.quantity" to overwrite, "cart.quantity" to leave it).
+CART_UPSERT_SQL = """
+    INSERT INTO cart (buyer_id, product_id, quantity, added_at)
+    SELECT ?, id, ?, ? FROM products WHERE id=? AND sold=0
+    ON CONFLICT (buyer_id, product_id) DO UPDATE SET quantity = {quantity}
+"""
+CART_SET_SQL = CART_UPSERT_SQL.format(quantity='excluded.quantity')
+CART_ADD_SQL = CART_UPSERT_SQL.format(quantity='cart.quantity')
+CART_UPDATE_SQL = "UPDATE cart SET quantity=? WHERE buyer_id=? AND product_id=?"
+
+HOT_QUERIES['buyer_cart.items'] = (CART_ITEMS_SQL, (1,))
+HOT_QUERIES['cart.summary'] = (CART_SUMMARY_SQL, (1,))
+
+class CartFull(ValueError):
+    pass
+
+def cart_summary(conn, buyer_id):
+    row = conn.execute(CART_SUMMARY_SQL, (buyer_id,)).fetchone()
+    return {'lines': row['lines'], 'quantity': row['quantity'], 'total': round(row['total'], 2),
+            'unavailable': row['unavailable']}
+
+def cart_item_json(it):
+    return {'product_id': it['id'], 'name': it['name'], 'price': it['price'], 'quantity': it['quantity'],
+            'farmer_name': it['farmer_name'], 'available': not it['sold'],
+            'line_total': round(it['price'] * it['quantity'], 2)}
+
+def set_cart_items(conn, buyer_id, items, in_cart_only=False):
+    """Upsert (product_id, quantity) pairs in one transaction. Quantity 0
+    removes the product; None adds one unless it's already in the cart.
+    With in_cart_only, products not already in the cart are skipped rather
+    than added. Returns the product ids that are sold or don't exist; raises
+    CartFull, changing nothing, if the cart would exceed CART_MAX_ITEMS."""
+    now = datetime.utcnow().isoformat()
+    unavailable = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for product_id, quantity in items:
+            if quantity == 0:
+                conn.execute("DELETE FROM cart WHERE buyer_id=? AND product_id=?", (buyer_id, product_id))
+                continue
+            if in_cart_only:
+                conn.execute(CART_UPDATE_SQL, (quantity or 1, buyer_id, product_id))
+                continue
+            sql = CART_ADD_SQL if quantity is None else CART_SET_SQL
+            if conn.execute(sql, (buyer_id, quantity or 1, now, product_id)).rowcount == 0:
+                unavailable.append(product_id)
+        count = conn.execute("SELECT COUNT(*) FROM cart WHERE buyer_id=?", (buyer_id,)).fetchone()[0]
+        if count > app.config['CART_MAX_ITEMS']:
+            raise CartFull(f"A cart holds at most {app.config['CART_MAX_ITEMS']} products.")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return unavailable
+
+def remove_cart_items(conn, buyer_id, product_ids):
+    conn.executemany("DELETE FROM cart WHERE buyer_id=? AND product_id=?", [(buyer_id, p) for p in product_ids])
+    conn.commit()
+
+def cart_quantity(value):
+    """A quantity from a form or JSON body, clamped to CART_MAX_QUANTITY."""
+    quantity = int(value)
+    return min(max(quantity, 0), app.config['CART_MAX_QUANTITY'])
+
+def cart_request_items(body):
+    """[(product_id, quantity)] from {"items": [{"product_id", "quantity"}, ...]}
+    or a single {"product_id", "quantity"}. Without a quantity the product
+    is added once and an existing line is left alone."""
+    entries = body.get('items') if isinstance(body.get('items'), list) else [body]
+    items = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get('product_id'), int) \
+                or isinstance(entry.get('product_id'), bool):
+            raise ValueError('expected "product_id" integers')
+        quantity = entry.get('quantity')
+        items.append((entry['product_id'], None if quantity is None else cart_quantity(quantity)))
+    if not items or len(items) > app.config['CART_MAX_ITEMS']:
+        raise ValueError('expected between 1 and %d items' % app.config['CART_MAX_ITEMS'])
+    return items
+
 @app.route('/buyer/add_to_cart/<int:pid>')
+@role_required('buyer')
 def add_to_cart(pid):
-    if not require_role('buyer'):
-        flash('Please login as buyer.', 'warning')
-        return redirect(url_for('buyer_login'))
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT sold FROM products WHERE id=?", (pid,))
-    pr = cur.fetchone()
-    if not pr or pr['sold'] == 1:
+    try:
+        unavailable = set_cart_items(get_db(), session['user_id'], [(pid, None)])
+    except CartFull as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('buyer_cart'))
+    if unavailable:
         flash('Item not available.', 'danger')
-        conn.close()
         return redirect(url_for('buyer_dashboard'))
-    cur.execute("SELECT id FROM cart WHERE buyer_id=? AND product_id=?", (session['user_id'], pid))
-    if not cur.fetchone():
-        cur.execute("INSERT INTO cart (buyer_id, product_id, added_at) VALUES (?,?,?)",
-                    (session['user_id'], pid, datetime.utcnow().isoformat()))
-        conn.commit()
-    conn.close()
     flash('Added to cart.', 'success')
     return redirect(url_for('buyer_cart'))
 
-@app.route('/buyer/cart')
+@app.route('/buyer/cart', methods=['GET', 'POST'])
+@role_required('buyer')
 def buyer_cart():
-    if not require_role('buyer'):
-        flash('Please login as buyer.', 'warning')
-        return redirect(url_for('buyer_login'))
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("""
-        SELECT c.id as cart_id, p.* , u.name AS farmer_name
-        FROM cart c
-        JOIN products p ON c.product_id = p.id
-        JOIN users u ON p.farmer_id = u.id
-        WHERE c.buyer_id=?
-    """, (session['user_id'],))
-    items = cur.fetchall()
-    conn.close()
-    return render_template('cart.html', items=items)
+    conn = get_db()
+    if request.method == 'POST':
+        # Quantities from the cart form (quantity-<product id> fields), for
+        # browsers without the script that edits them in place.
+        try:
+            items = [(int(key.split('-', 1)[1]), cart_quantity(value))
+                     for key, value in request.form.items() if key.startswith('quantity-')]
+        except ValueError:
+            flash('Quantities must be whole numbers.', 'danger')
+        else:
+            try:
+                set_cart_items(conn, session['user_id'], items, in_cart_only=True)
+            except CartFull as e:
+                flash(str(e), 'warning')
+            else:
+                flash('Cart updated.', 'success')
+        return redirect(url_for('buyer_cart'))
+    items = conn.execute(CART_ITEMS_SQL, (session['user_id'],)).fetchall()
+    return render_template('cart.html', items=items, summary=cart_summary(conn, session['user_id']))
 
 @app.route('/buyer/remove_from_cart/<int:cart_id>')
+@role_required('buyer')
 def remove_from_cart(cart_id):
-    if not require_role('buyer'):
-        flash('Please login as buyer.', 'warning')
-        return redirect(url_for('buyer_login'))
     conn = get_db(); cur = conn.cursor()
     cur.execute("DELETE FROM cart WHERE id=? AND buyer_id=?", (cart_id, session['user_id']))
-    conn.commit(); conn.close()
+    conn.commit()
     flash('Removed from cart.', 'info')
     return redirect(url_for('buyer_cart'))
 
+@app.route('/api/cart')
+def api_cart():
+    """The buyer's cart lines and summary."""
+    if not require_role('buyer'):
+        return jsonify({'error': 'Please login as buyer.'}), 401
+    conn = get_db()
+    items = conn.execute(CART_ITEMS_SQL, (session['user_id'],)).fetchall()
+    return jsonify(items=[cart_item_json(it) for it in items], **cart_summary(conn, session['user_id']))
+
+@app.route('/api/cart/summary')
+def api_cart_summary():
+    """Counts and total for the header badge."""
+    if not require_role('buyer'):
+        return jsonify({'error': 'Please login as buyer.'}), 401
+    resp = jsonify(cart_summary(get_db(), session['user_id']))
+    resp.cache_control.private = True
+    resp.cache_control.no_store = True
+    return resp
+
+@app.route('/api/cart/items', methods=['POST', 'DELETE'])
+def api_cart_items():
+    """POST adds products or sets their quantities ({"items": [{"product_id",
+    "quantity"}]}, 0 removes); DELETE removes {"product_ids": [...]}. Both
+    are idempotent and answer with the new summary."""
+    if not require_role('buyer'):
+        return jsonify({'error': 'Please login as buyer.'}), 401
+    body = request.get_json(silent=True) or {}
+    conn = get_db()
+    unavailable = []
+    if request.method == 'DELETE':
+        ids = body.get('product_ids')
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            return jsonify({'error': 'expected "product_ids"'}), 400
+        remove_cart_items(conn, session['user_id'], ids)
+    else:
+        try:
+            unavailable = set_cart_items(conn, session['user_id'], cart_request_items(body))
+        except CartFull as e:
+            return jsonify({'error': str(e)}), 409
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+    return jsonify(unavailable_ids=unavailable, **cart_summary(conn, session['user_id']))
+
+def checkout_cart(conn, buyer_id):
+    """Turn the buyer's cart into orders in one write transaction.
+
+    Products are claimed with a single conditional UPDATE, so a product that
+    another buyer got first simply isn't returned and can never be sold
+    twice. Returns (orders placed as (product_id, farmer_id) rows,
+    cart rows that could not be bought as (product_id, quantity, name) rows).
+    """
+    now = datetime.utcnow().isoformat()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        wanted = conn.execute("""
+            SELECT c.product_id, c.quantity, p.name
+            FROM cart c LEFT JOIN products p ON c.product_id = p.id
+            WHERE c.buyer_id=?
+        """, (buyer_id,)).fetchall()
+        claimed = conn.execute("""
+            UPDATE products SET sold=1
+            WHERE sold=0 AND id IN (SELECT product_id FROM cart WHERE buyer_id=?)
+            RETURNING id AS product_id, farmer_id
+        """, (buyer_id,)).fetchall()
+        if not claimed:
+            conn.rollback()
+            return [], wanted
+        quantities = {r['product_id']: r['quantity'] for r in wanted}
+        conn.executemany("""INSERT INTO orders (product_id, buyer_id, farmer_id, quantity, status, created_at)
+                            VALUES (?,?,?,?,?,?)""",
+                         [(r['product_id'], buyer_id, r['farmer_id'], quantities[r['product_id']], 'placed_cod', now)
+                          for r in claimed])
+        queue_notification(conn, 'order_placed', {
+            'buyer_id': buyer_id, 'items': [[r['product_id'], r['farmer_id']] for r in claimed]})
+        conn.execute("DELETE FROM cart WHERE buyer_id=?", (buyer_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    placed = {r['product_id'] for r in claimed}
+    return claimed, [r for r in wanted if r['product_id'] not in placed]
+
 @app.route('/buyer/checkout', methods=['POST'])
+@role_required('buyer')
 def checkout():
-    if not require_role('buyer'):
-        flash('Please login as buyer.', 'warning')
-        return redirect(url_for('buyer_login'))
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("""
-        SELECT c.id as cart_id, p.id as pid, p.farmer_id
-        FROM cart c JOIN products p ON c.product_id=p.id
-        WHERE c.buyer_id=? AND p.sold=0
-    """, (session['user_id'],))
-    rows = cur.fetchall()
-    if not rows:
+    placed, lost = checkout_cart(get_db(), session['user_id'])
+    if not placed:
         flash('Cart is empty or items unavailable.', 'warning')
-        conn.close()
         return redirect(url_for('buyer_cart'))
-    for r in rows:
-        cur.execute("""INSERT INTO orders (product_id, buyer_id, farmer_id, status, created_at) VALUES (?,?,?,?,?)""",                    (r['pid'], session['user_id'], r['farmer_id'], 'placed_cod', datetime.utcnow().isoformat()))
-        cur.execute("UPDATE products SET sold=1 WHERE id=?", (r['pid'],))
-        cur.execute("""INSERT INTO notifications (user_id, message, created_at) VALUES (?,?,?)""",                    (r['farmer_id'], f"Your product #{r['pid']} was ordered (Cash on Delivery).", datetime.utcnow().isoformat()))
-        cur.execute("""INSERT INTO notifications (user_id, message, created_at) VALUES (?,?,?)""",                    (session['user_id'], f"Order placed for product #{r['pid']} (COD).", datetime.utcnow().isoformat()))
-    cur.execute("DELETE FROM cart WHERE buyer_id=?", (session['user_id'],))
-    conn.commit(); conn.close()
+    catalog_changed()
+    outbox_changed()
+    for item in lost:
+        flash(f"Sorry, {item['name'] or 'product #%d' % item['product_id']} is no longer available "
+              f"and was not ordered.", 'warning')
     flash('Order placed! Seller and you have been notified. Items removed from listing.', 'success')
     return redirect(url_for('buyer_dashboard'))
 
 # ---- Reviews ----
 @app.route('/buyer/review/<int:pid>', methods=['POST'])
+@role_required('buyer', 'Login as buyer to review.')
 def review(pid):
-    if not require_role('buyer'):
-        flash('Login as buyer to review.', 'warning')
-        return redirect(url_for('buyer_login'))
     rating = int(request.form['rating'])
     text = request.form.get('text','').strip()
     conn = get_db(); cur = conn.cursor()
     cur.execute("""INSERT INTO reviews (product_id, buyer_id, rating, text, created_at) VALUES (?,?,?,?,?)""",                (pid, session['user_id'], rating, text, datetime.utcnow().isoformat()))
-    conn.commit(); conn.close()
+    queue_notification(conn, 'review_posted', {'product_id': pid, 'buyer_id': session['user_id'], 'rating': rating})
+    conn.commit()
+    catalog_changed()
+    outbox_changed()
     flash('Thanks for your review!', 'success')
     return redirect(request.referrer or url_for('buyer_dashboard'))
 
+# ---- Notifications ----
+def notification_json(n):
+    return {'id': n['id'], 'message': n['message'], 'is_read': bool(n['is_read']), 'created_at': n['created_at']}
+
+@app.route('/api/notifications')
+def api_notifications():
+    """Newest notifications first, paged by ?cursor=, plus the unread count."""
+    user = current_user()
+    if not user:
+        return jsonify(error='login required'), 401
+    before = decode_cursor(request.args.get('cursor'))
+    sql = NOTIFICATION_FEED_SQL.format(before='AND id < ?' if before else '')
+    size = page_size()
+    cur = get_db().cursor()
+    notes, cursor = fetch_page(cur, sql, (user['id'], *([before[1]] if before else ()), size + 1), size,
+                               newest_first)
+    unread = cur.execute(UNREAD_COUNT_SQL, (user['id'],)).fetchone()[0]
+    return jsonify(items=[notification_json(n) for n in notes], unread=unread, next_cursor=cursor)
+
+@app.route('/api/notifications/read', methods=['POST'])
+def mark_notifications_read():
+    """Mark notifications read: {"ids": [...]} or everything up to {"up_to": id}."""
+    user = current_user()
+    if not user:
+        return jsonify(error='login required'), 401
+    body = request.get_json(silent=True) or {}
+    conn = get_db()
+    if isinstance(body.get('up_to'), int):
+        conn.execute("UPDATE notifications SET is_read=1 WHERE user_id=? AND is_read=0 AND id <= ?",
+                     (user['id'], body['up_to']))
+    elif isinstance(body.get('ids'), list) and all(isinstance(i, int) for i in body['ids']):
+        conn.executemany("UPDATE notifications SET is_read=1 WHERE user_id=? AND id=?",
+                         [(user['id'], i) for i in body['ids']])
+    else:
+        return jsonify(error='expected "ids" or "up_to"'), 400
+    conn.commit()
+    return jsonify(unread=conn.execute(UNREAD_COUNT_SQL, (user['id'],)).fetchone()[0])
+
+@app.route('/api/notifications/stream')
+def notification_stream():
+    """Server-Sent Events: one `notification` event per batch of new rows.
+
+    Resumes after Last-Event-ID (or ?after=) when the browser reconnects.
+    """
+    user = current_user()
+    if not user:
+        return jsonify(error='login required'), 401
+    uid = user['id']
+    if not notification_hub.claim_stream(app.config['NOTIFY_MAX_STREAMS']):
+        # Busy: tell EventSource when to retry; the page polls meanwhile.
+        notification_streams_refused.inc(())
+        retry = app.config['NOTIFY_RETRY_SECONDS']
+        return Response(f"retry: {retry * 1000}\n\n", status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(retry), 'Cache-Control': 'no-cache'})
+    after = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', 0, type=int)
+    start_outbox_worker()
+    heartbeat = app.config['NOTIFY_HEARTBEAT_SECONDS']
+    deadline = time.monotonic() + app.config['NOTIFY_STREAM_SECONDS']
+
+    def events():
+        nonlocal after
+        yield f"retry: {heartbeat * 1000}\n\n"
+        while time.monotonic() < deadline and not app_stopping.is_set():
+            version = notification_hub.version(uid)
+            # Hold a pooled connection only while querying, never while idle.
+            conn = db_pool.acquire()
+            try:
+                notes = conn.execute(NOTIFICATIONS_SINCE_SQL, (uid, after, app.config['MAX_PAGE_SIZE'])).fetchall()
+                unread = conn.execute(UNREAD_COUNT_SQL, (uid,)).fetchone()[0] if notes else None
+            finally:
+                db_pool.release(conn)
+            if notes:
+                after = notes[-1]['id']
+                data = json.dumps({'items': [notification_json(n) for n in notes], 'unread': unread})
+                yield f"id: {after}\nevent: notification\ndata: {data}\n\n"
+                continue
+            if not notification_hub.wait(uid, version, heartbeat):
+                yield ": keepalive\n\n"
+
+    resp = Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(notification_hub.release_stream)
+    return resp
+
+# ---- Analytics ----
+@app.route('/api/farmer/analytics')
+def api_farmer_analytics():
+    """The farmer's own sales, listings and ratings per day over ?days=."""
+    if not require_role('farmer'):
+        return jsonify({'error': 'Please login as farmer.'}), 401
+    return jsonify(farmer_report(get_db(), session['user_id'], report_days()))
+
+@app.route('/api/admin/analytics')
+def api_admin_analytics():
+    """Marketplace totals per day over ?days=, and the top farmers by revenue."""
+    if not require_role('admin'):
+        return jsonify({'error': 'Admin only.'}), 401
+    top = min(max(request.args.get('top', app.config['ANALYTICS_TOP_FARMERS'], type=int) or 1, 1), 100)
+    return jsonify(marketplace_report(get_db(), report_days(), top))
+
+# ---- Bulk import / export ----
+def import_request(farmer_id):
+    """Run an import from a multipart `file` field or a raw CSV/JSONL body."""
+    if request.mimetype == 'multipart/form-data':
+        file = request.files.get('file')
+        if not file:
+            return jsonify({'error': 'No file field in upload'}), 400
+        stream, fmt = file.stream, import_format(file.filename, file.mimetype)
+    else:
+        stream, fmt = request.stream, import_format(None, request.mimetype)
+    if fmt is None:
+        return jsonify({'error': f"format must be one of {', '.join(IMPORT_FORMATS)}"}), 400
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if fmt == 'csv' else None)
+    report = import_products(get_db(), text, fmt, farmer_id)
+    return jsonify(report._asdict()), 200 if report.imported or not report.failed else 400
+
+@app.route('/farmer/import', methods=['POST'])
+def farmer_import():
+    """Bulk-add the logged-in farmer's products from CSV or JSONL."""
+    if not require_role('farmer'):
+        return jsonify({'error': 'Please login as farmer.'}), 401
+    return import_request(session['user_id'])
+
+@app.route('/admin/import', methods=['POST'])
+def admin_import():
+    """Bulk-add products for any farmer; every row carries farmer_id."""
+    if not require_role('admin'):
+        return jsonify({'error': 'Admin only.'}), 401
+    return import_request(None)
+
+@app.route('/farmer/export/products.<fmt>')
+@role_required('farmer')
+def farmer_export(fmt):
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({'error': 'Unknown export format'}), 404
+    return export_response('products', fmt, export_rows('products', 'AND farmer_id=?', (session['user_id'],)))
+
+@app.route('/admin/export/<table>.<fmt>')
+@role_required('admin')
+def admin_export(table, fmt):
+    if table not in EXPORT_COLUMNS or fmt not in IMPORT_FORMATS:
+        return jsonify({'error': 'Unknown export'}), 404
+    return export_response(table, fmt, export_rows(table))
+
 # ---- Admin ----
 @app.route('/admin/login', methods=['GET','POST'])
 def admin_login():
@@ -487,6 +3604,9 @@ def admin_login():
     if request.method == 'POST':
         email = request.form['email'].strip().lower()
         password = request.form['password']
+        wait = login_throttled('admin', email)
+        if wait:
+            return too_many_attempts(wait)
 
         # Check if credentials match permanent developer admin
         if email == DEV_ADMIN_EMAIL and password == DEV_ADMIN_PASSWORD:
@@ -498,69 +3618,129 @@ def admin_login():
             flash('Developer admin logged in successfully!', 'success')
             return redirect(url_for('admin_dashboard'))
 
+        login_failed('admin', email)
         flash('Invalid admin credentials', 'danger')
 
     return render_template('admin_login.html')
 
-def require_role(role):
-    user = current_user()
-    # Normal users
-    if user and user['role'] == role:
-        return True
-
-    # Special case: permanent developer admin
-    if session.get('role') == 'admin' and session.get('is_developer_admin'):
-        return True
-
-    return False
-
-
 @app.route('/admin/dashboard')
+@role_required('admin')
 def admin_dashboard():
-    if not require_role('admin'):
-        flash('Admin only.', 'danger')
-        return redirect(url_for('admin_login'))
     conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE role!='admin' ORDER BY created_at DESC")
-    users = cur.fetchall()
-    cur.execute("""
-        SELECT p.*, u.name as farmer_name FROM products p
-        JOIN users u ON p.farmer_id=u.id
-        ORDER BY p.created_at DESC
-    """)
-    products = cur.fetchall()
-    conn.close()
-    return render_template('admin_dashboard.html', users=users, products=products)
+    size = page_size()
+    partial = request.args.get('partial')
+    users_cursor = request.args.get('users_cursor')
+    products_cursor = request.args.get('products_cursor')
+    users = products = ()
+    next_users = next_products = None
+    if partial != 'products':
+        after = decode_cursor(users_cursor)
+        users, cursor = fetch_page(cur, """
+            SELECT * FROM users WHERE role!='admin' {after}
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        """.format(after='AND (created_at, id) < (?, ?)' if after else ''),
+            (*(after or ()), size + 1), size, newest_first)
+        if cursor:
+            next_users = url_for('admin_dashboard', users_cursor=cursor, products_cursor=products_cursor)
+    if partial != 'users':
+        after = decode_cursor(products_cursor)
+        products, cursor = fetch_page(cur, """
+            SELECT p.*, u.name as farmer_name FROM products p
+            JOIN users u ON p.farmer_id=u.id
+            {after}
+            ORDER BY p.created_at DESC, p.id DESC LIMIT ?
+        """.format(after='WHERE (p.created_at, p.id) < (?, ?)' if after else ''),
+            (*(after or ()), size + 1), size, newest_first)
+        if cursor:
+            next_products = url_for('admin_dashboard', users_cursor=users_cursor, products_cursor=cursor)
+    if partial == 'users':
+        resp = make_response(render_template('_admin_user_rows.html', users=users))
+        resp.headers['X-Next-Page'] = next_users or ''
+        return resp
+    if partial == 'products':
+        resp = make_response(render_template('_admin_product_rows.html', products=products))
+        resp.headers['X-Next-Page'] = next_products or ''
+        return resp
+    report = marketplace_report(conn, app.config['ANALYTICS_DAYS'], app.config['ANALYTICS_TOP_FARMERS'])
+    return render_template('admin_dashboard.html', users=users, products=products,
+                           next_users=next_users, next_products=next_products, report=report)
 
 @app.route('/admin/delete_user/<int:uid>')
+@role_required('admin')
 def admin_delete_user(uid):
-    if not require_role('admin'):
-        flash('Admin only.', 'danger')
-        return redirect(url_for('admin_login'))
     conn = get_db(); cur = conn.cursor()
     cur.execute("DELETE FROM users WHERE id=? AND role!='admin'", (uid,))
-    conn.commit(); conn.close()
+    conn.commit()
+    forget_user(uid)
     flash('User removed.', 'info')
     return redirect(url_for('admin_dashboard'))
 
 @app.route('/admin/delete_product/<int:pid>')
+@role_required('admin')
 def admin_delete_product(pid):
-    if not require_role('admin'):
-        flash('Admin only.', 'danger')
-        return redirect(url_for('admin_login'))
     conn = get_db(); cur = conn.cursor()
     cur.execute("DELETE FROM products WHERE id=?", (pid,))
-    conn.commit(); conn.close()
+    conn.commit()
+    collect_uploads(conn)
+    catalog_changed()
     flash('Product removed.', 'info')
     return redirect(url_for('admin_dashboard'))
 
 # ---------- Static uploads serving ----------
+# Store paths name their content, so they can be cached forever.
+STORED_UPLOAD = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64}(?:_\d+w)?)\.[a-z]+$')
+
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    stored = STORED_UPLOAD.match(filename)
+    if not stored:
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # send_file answers If-None-Match / If-Modified-Since with 304 and Range with 206.
+    resp = send_from_directory(app.config['UPLOAD_FOLDER'], filename, etag=stored.group(1),
+                               max_age=app.config['UPLOAD_CACHE_MAX_AGE'])
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
 
 # ---------- App start ----------
+# Set when the server starts shutting down, so long-lived responses (event
+# streams) finish early and let in-flight requests drain.
+app_stopping = threading.Event()
+
+def create_app(config=None):
+    """Configure the app and bring the schema up to date; call once per
+    deployment before any worker starts serving (see serve.py). SECRET_KEY
+    and DATABASE come from the environment when set there."""
+    app.config.update(config or {})
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    with app.app_context():
+        init_db()
+    return app
+
+def warm_up():
+    """Do what the first requests would otherwise pay for: compile every
+    template, fill the connection pool, touch the indexes the hot queries
+    and search use, load the catalog snapshot if enabled and render the
+    first catalog page into the cache. Also starts the maintenance thread
+    when MAINTENANCE_WORKER is on."""
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+    conns = [db_pool.acquire() for _ in range(app.config['DB_POOL_SIZE'])]
+    try:
+        for sql, params in HOT_QUERIES.values():
+            conns[0].execute(sql, params).fetchall()
+    finally:
+        for conn in conns:
+            db_pool.release(conn)
+    with app.test_request_context('/buyer/dashboard'):
+        if app.config['CATALOG_SNAPSHOT']:
+            catalog_snapshot.load()
+        size = app.config['PAGE_SIZE']
+        product_tiles(lambda: list_products(None, size), 'listing', None, size)
+    if app.config['MAINTENANCE_WORKER']:
+        start_maintenance_worker()
+
 if __name__ == '__main__':
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    init_db()
+    # Single-process debug server; use serve.py in production.
+    create_app()
     app.run(debug=True)
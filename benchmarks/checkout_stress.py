@@ -0,0 +1,92 @@
+"""Many buyers checking out the same products at once.
+
+    python benchmarks/checkout_stress.py                 # 32 buyers, 20 products
+    python benchmarks/checkout_stress.py --buyers 64 --products 50
+
+Every buyer puts every product in their cart, then all of them hit
+/buyer/checkout together from separate threads. Afterwards each product must
+have exactly one order and be marked sold; the script exits non-zero if not.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as farm  # noqa: E402
+
+
+def seed(conn, buyers, products):
+    now = datetime.utcnow().isoformat()
+    conn.execute("INSERT INTO users (role, name, password_hash, created_at) VALUES ('farmer', 'Farmer', 'x', ?)",
+                 (now,))
+    farmer_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    conn.executemany("INSERT INTO users (role, name, password_hash, created_at) VALUES ('buyer', ?, 'x', ?)",
+                     [(f'Buyer {i}', now) for i in range(buyers)])
+    buyer_ids = [r[0] for r in conn.execute("SELECT id FROM users WHERE role='buyer' ORDER BY id")]
+    conn.executemany("INSERT INTO products (farmer_id, name, price, created_at) VALUES (?,?,?,?)",
+                     [(farmer_id, f'Lot {i}', 100, now) for i in range(products)])
+    product_ids = [r[0] for r in conn.execute("SELECT id FROM products ORDER BY id")]
+    conn.executemany("INSERT INTO cart (buyer_id, product_id, added_at) VALUES (?,?,?)",
+                     [(b, p, now) for b in buyer_ids for p in product_ids])
+    conn.commit()
+    return buyer_ids
+
+
+def run(buyers, products):
+    with tempfile.TemporaryDirectory() as tmp:
+        farm.app.config['DATABASE'] = os.path.join(tmp, 'stress.db')
+        with farm.app.app_context():
+            farm.init_db()
+            buyer_ids = seed(farm.get_db(), buyers, products)
+
+        start_gate = threading.Barrier(len(buyer_ids))
+        latencies, statuses = [], []
+        lock = threading.Lock()
+
+        def buyer(uid):
+            client = farm.app.test_client()
+            with client.session_transaction() as sess:
+                sess.update(user_id=uid, role='buyer', name=f'Buyer {uid}')
+            start_gate.wait()
+            started = time.perf_counter()
+            resp = client.post('/buyer/checkout')
+            with lock:
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses.append(resp.status_code)
+
+        threads = [threading.Thread(target=buyer, args=(uid,)) for uid in buyer_ids]
+        wall = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - wall
+
+        with farm.app.app_context():
+            conn = farm.get_db()
+            orders = conn.execute("SELECT COUNT(*), COUNT(DISTINCT product_id) FROM orders").fetchone()
+            unsold = conn.execute("SELECT COUNT(*) FROM products WHERE sold=0").fetchone()[0]
+            winners = conn.execute("SELECT COUNT(DISTINCT buyer_id) FROM orders").fetchone()[0]
+        farm.db_pool.close_all()
+
+    latencies.sort()
+    print(f"{buyers} buyers x {products} products in {wall:.2f}s; "
+          f"checkout p50 {statistics.median(latencies):.1f}ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.1f}ms, errors {sum(s >= 500 for s in statuses)}")
+    print(f"orders {orders[0]} for {orders[1]} distinct products, {winners} winning buyers, {unsold} unsold")
+    ok = orders[0] == orders[1] == products and unsold == 0 and all(s < 500 for s in statuses)
+    print('OK' if ok else 'OVERSOLD OR FAILED')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--buyers', type=int, default=32)
+    parser.add_argument('--products', type=int, default=20)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.buyers, args.products) else 1)
@@ -0,0 +1,84 @@
+"""Time a bulk product import and its export, and report peak memory.
+
+    python benchmarks/import_benchmark.py              # 100k rows
+    python benchmarks/import_benchmark.py 250000
+    python benchmarks/import_benchmark.py --trace      # also report peak Python heap
+
+Tracing allocations slows everything down, so --trace timings aren't
+comparable with untraced ones. (Process RSS is no use here: the database is
+memory-mapped, so reading it shows up as resident memory.)
+
+The CSV is written to a temp file first and imported through the same
+import_products() the /farmer/import endpoint and import-products CLI use.
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as farm  # noqa: E402
+from search_benchmark import ADJECTIVES, CROPS, PLACES, UNITS  # noqa: E402
+
+
+def write_csv(path, n, rng):
+    with open(path, 'w', encoding='utf-8', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(['name', 'price', 'description', 'phone'])
+        for i in range(n):
+            writer.writerow([f"{rng.choice(ADJECTIVES)} {rng.choice(CROPS)}".strip(), rng.randint(10, 5000),
+                             f"{rng.choice(UNITS)}, {rng.choice(PLACES)}", f'9{i:09d}'])
+
+
+def peak_heap():
+    """Peak traced heap since the last call, or '' when not tracing."""
+    if not tracemalloc.is_tracing():
+        return ''
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    return f", peak heap {peak / 2**20:.1f} MiB"
+
+
+def run(n):
+    rng = random.Random(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        farm.app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        path = os.path.join(tmp, 'products.csv')
+        write_csv(path, n, rng)
+        with farm.app.app_context():
+            farm.init_db()
+            conn = farm.get_db()
+            conn.execute("INSERT INTO users (role, name, password_hash, created_at) VALUES ('farmer', 'Co-op', 'x', ?)",
+                         (datetime.utcnow().isoformat(),))
+            conn.commit()
+            farmer_id = conn.execute("SELECT id FROM users").fetchone()[0]
+
+            peak_heap()
+            start = time.perf_counter()
+            with open(path, encoding='utf-8-sig', newline='') as src:
+                report = farm.import_products(conn, src, 'csv', farmer_id)
+            took = time.perf_counter() - start
+            print(f"import {report.imported:,} rows ({report.failed} rejected) in {took:.2f}s "
+                  f"= {report.imported / took:,.0f} rows/s{peak_heap()}")
+
+            start = time.perf_counter()
+            size = sum(len(chunk) for chunk in farm.export_lines('products', 'csv', farm.export_rows('products')))
+            took = time.perf_counter() - start
+            print(f"export {size / 2**20:.1f} MiB of CSV in {took:.2f}s{peak_heap()}")
+        farm.db_pool.close_all()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rows', type=int, nargs='*', default=[100_000], help='rows to import, one run each')
+    parser.add_argument('--trace', action='store_true', help='also report peak Python heap (slower)')
+    args = parser.parse_args()
+    if args.trace:
+        tracemalloc.start()
+    for n in args.rows:
+        run(n)
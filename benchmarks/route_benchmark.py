@@ -0,0 +1,250 @@
+"""Drive the real routes through the Flask test client and time them.
+
+    python benchmarks/route_benchmark.py                          # small scale
+    python benchmarks/route_benchmark.py --scale medium --threads 4 --output results.json
+    python benchmarks/route_benchmark.py --compare results.json   # exit 1 on regressions
+
+Each scenario runs against a freshly seeded database (see seed_data.py) as a
+logged-in buyer, after a short warmup. Results hold throughput and
+p50/p90/p99 latency per scenario together with the commit, Python and SQLite
+versions, so runs from different versions can be compared.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed_data import SCALES, farm, seed_database  # noqa: E402
+
+QUERIES = ['rice', 'akki', 'ragi', 'ರಾಗಿ', 'organic tomato', 'tengu', 'mandya', 'sun dried', 'adike', 'zzz']
+PREFIXES = ['ri', 'ak', 'ra', 'ಅಕ್', 'tom', 'on', 'gro', 'cof', 'ma', 'tur', 'ja', 'ban']
+
+
+class Catalog:
+    """Unsold product ids handed out to scenarios that buy or cart them."""
+    def __init__(self, ids):
+        self._ids = ids
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            return self._ids.pop()
+
+
+# Each scenario is (setup, request): setup runs untimed before every request.
+def buyer_dashboard(client, rng, catalog):
+    return client.get('/buyer/dashboard')
+
+
+def search(client, rng, catalog):
+    return client.get('/search', query_string={'q': rng.choice(QUERIES)})
+
+
+def suggest(client, rng, catalog):
+    return client.get('/api/suggest', query_string={'q': rng.choice(PREFIXES)})
+
+
+def add_to_cart(client, rng, catalog):
+    return client.get(f'/buyer/add_to_cart/{catalog.take()}')
+
+
+def cart_api_add(client, rng, catalog):
+    return client.post('/api/cart/items', json={'product_id': catalog.take()})
+
+
+def cart_summary(client, rng, catalog):
+    return client.get('/api/cart/summary')
+
+
+def fill_cart(client, rng, catalog):
+    for _ in range(rng.randint(1, 3)):
+        client.get(f'/buyer/add_to_cart/{catalog.take()}')
+
+
+def checkout(client, rng, catalog):
+    return client.post('/buyer/checkout')
+
+
+def review(client, rng, catalog):
+    return client.post(f'/buyer/review/{rng.randint(1, catalog.products)}',
+                       data={'rating': str(rng.randint(1, 5)), 'text': 'benchmark'})
+
+
+SCENARIOS = {
+    'buyer_dashboard': (None, buyer_dashboard),
+    'search': (None, search),
+    'suggest': (None, suggest),
+    'add_to_cart': (None, add_to_cart),
+    'cart_api_add': (None, cart_api_add),
+    'cart_summary': (None, cart_summary),
+    'checkout': (fill_cart, checkout),
+    'review': (None, review),
+}
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of sorted samples."""
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+
+def run_scenario(name, buyer_ids, catalog, requests, threads, warmup, seed):
+    """Time one scenario. Throughput counts only time spent in the timed
+    requests, so untimed setup doesn't drag it down."""
+    setup, scenario = SCENARIOS[name]
+    per_thread = [requests // threads + (i < requests % threads) for i in range(threads)]
+    latencies, errors, rates = [], [], []
+    lock = threading.Lock()
+    gate = threading.Barrier(threads + 1)
+
+    def request(client, rng):
+        if setup:
+            setup(client, rng, catalog)
+        start = time.perf_counter()
+        resp = scenario(client, rng, catalog)
+        return time.perf_counter() - start, resp
+
+    def worker(index, count):
+        rng = random.Random(f'{seed}-{name}-{index}')
+        client = farm.app.test_client()
+        with client.session_transaction() as sess:
+            sess.update(user_id=buyer_ids[index % len(buyer_ids)], role='buyer', name='Bench')
+        try:
+            for _ in range(warmup):
+                request(client, rng)
+        finally:
+            gate.wait()   # a broken warmup still releases the other threads
+        mine, failed = [], 0
+        for _ in range(count):
+            took, resp = request(client, rng)
+            mine.append(took)
+            failed += resp.status_code >= 400
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+            rates.append(len(mine) / sum(mine))
+
+    pool = [threading.Thread(target=worker, args=(i, n)) for i, n in enumerate(per_thread)]
+    for t in pool:
+        t.start()
+    gate.wait()
+    for t in pool:
+        t.join()
+    if len(latencies) < requests:
+        raise RuntimeError(f'{name}: a worker thread failed')
+    latencies.sort()
+    ms = [x * 1000 for x in latencies]
+    return {
+        'requests': len(ms), 'errors': sum(errors), 'throughput_rps': round(sum(rates), 1),
+        'mean_ms': round(sum(ms) / len(ms), 3), 'p50_ms': round(percentile(ms, 50), 3),
+        'p90_ms': round(percentile(ms, 90), 3), 'p99_ms': round(percentile(ms, 99), 3),
+        'max_ms': round(ms[-1], 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Scenarios whose p50 or throughput got worse by more than `tolerance`."""
+    regressions = []
+    for name, now in results['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        if now['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {before['p50_ms']:.2f} -> {now['p50_ms']:.2f} ms")
+        if now['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['throughput_rps']} -> {now['throughput_rps']} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=300, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests per thread first')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated subset')
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--compare', help='baseline results JSON to check against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown vs baseline (0.2 = 20%%)')
+    parser.add_argument('--catalog-snapshot', action='store_true', help='serve listings from the in-memory catalog')
+    args = parser.parse_args()
+    names = [n for n in args.scenarios.split(',') if n]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # Every simulated buyer shares one address; measure the routes, not the limiter.
+    farm.app.config['RATE_LIMIT_ENABLED'] = False
+    # A few buyers add thousands of products between them.
+    farm.app.config['CART_MAX_ITEMS'] = 1_000_000
+    farm.app.config['CATALOG_SNAPSHOT'] = args.catalog_snapshot
+    with tempfile.TemporaryDirectory() as tmp:
+        started = time.perf_counter()
+        written = seed_database(os.path.join(tmp, 'bench.db'), args.scale, args.seed)
+        print(f"seeded {args.scale}: " + ', '.join(f'{n:,} {t}' for t, n in written.items())
+              + f" in {time.perf_counter() - started:.1f}s")
+        with farm.app.app_context():
+            conn = farm.get_db()
+            buyer_ids = [r[0] for r in conn.execute("SELECT id FROM users WHERE role='buyer' ORDER BY id")]
+            unsold = [r[0] for r in conn.execute("SELECT id FROM products WHERE sold=0")]
+            products = conn.execute("SELECT MAX(id) FROM products").fetchone()[0]
+        random.Random(args.seed).shuffle(unsold)
+        catalog = Catalog(unsold)
+        catalog.products = products
+
+        results = {
+            'meta': {
+                'commit': git_commit(), 'timestamp': datetime.utcnow().isoformat() + 'Z',
+                'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(), 'scale': args.scale, 'seed': args.seed, 'rows': written,
+                'requests': args.requests, 'warmup': args.warmup, 'threads': args.threads,
+                'catalog_snapshot': args.catalog_snapshot,
+            },
+            'results': {},
+        }
+        print(f"{'scenario':<18}{'req/s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'errors':>8}")
+        for name in names:
+            r = run_scenario(name, buyer_ids, catalog, args.requests, args.threads, args.warmup, args.seed)
+            results['results'][name] = r
+            print(f"{name:<18}{r['throughput_rps']:>9}{r['p50_ms']:>9.2f}{r['p90_ms']:>9.2f}"
+                  f"{r['p99_ms']:>9.2f}{r['errors']:>8}")
+        farm.db_pool.close_all()
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for key in ('scale', 'seed', 'threads', 'python', 'sqlite'):
+            if baseline.get('meta', {}).get(key) != results['meta'][key]:
+                print(f"note: baseline {key} was {baseline.get('meta', {}).get(key)!r}, "
+                      f"now {results['meta'][key]!r}; numbers may not be comparable")
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""Compare the old LIKE search with the FTS5 search at several catalog sizes.
+
+    python benchmarks/search_benchmark.py                 # 10k, 100k, 1M
+    python benchmarks/search_benchmark.py 10000 50000
+
+Each size gets a fresh throwaway database built through init_db(), so the
+schema, triggers and indexes are exactly what the app runs with.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as farm  # noqa: E402
+
+CROPS = ['rice', 'basmati rice', 'sona masuri rice', 'wheat', 'finger millet', 'ragi', 'horse gram',
+         'pigeon pea', 'chickpea', 'beans', 'paddy', 'sugar', 'coconut', 'tomato', 'onion', 'potato',
+         'mango', 'banana', 'jowar', 'maize', 'groundnut', 'akki', 'godhi', 'tengu', 'ಅಕ್ಕಿ', 'ರಾಗಿ', 'ತೆಂಗು']
+ADJECTIVES = ['organic', 'fresh', 'premium', 'local', 'new harvest', 'sun dried', 'hand picked', '']
+PLACES = ['Mandya', 'Hassan', 'Tumakuru', 'Mysuru', 'Belagavi', 'Raichur', 'Shivamogga', 'Kolar']
+UNITS = ['per kg', 'per quintal', 'per ton', 'per dozen']
+QUERIES = ['rice', 'akki', 'akki basmati', 'tom', 'finger millet', 'organic ragi', 'mandya', 'zzz']
+LIMIT = 25   # one page of results, for both queries
+
+LIKE_SQL = """
+    SELECT p.*, u.name AS farmer_name
+    FROM products p
+    JOIN users u ON p.farmer_id = u.id
+    WHERE p.sold=0 AND (LOWER(p.name) LIKE ? OR LOWER(p.description) LIKE ?)
+    ORDER BY COALESCE(p.rating_sum * 1.0 / NULLIF(p.review_count, 0), 0) DESC, p.id
+    LIMIT ?
+"""
+
+
+def populate(conn, n, rng):
+    now = datetime.utcnow()
+    farmers = max(1, n // 100)
+    conn.executemany(
+        "INSERT INTO users (role, name, phone, password_hash, created_at) VALUES ('farmer', ?, ?, 'x', ?)",
+        ((f'Farmer {i}', f'9{i:09d}', now.isoformat()) for i in range(farmers)))
+
+    def rows():
+        for i in range(n):
+            name = f"{rng.choice(ADJECTIVES)} {rng.choice(CROPS)}".strip()
+            desc = f"{rng.choice(UNITS)}, {rng.choice(PLACES)}"
+            reviews = rng.randint(0, 20)
+            yield (rng.randint(1, farmers), name, desc, rng.randint(10, 5000), int(rng.random() < 0.3),
+                   (now - timedelta(minutes=i)).isoformat(), reviews, reviews * rng.randint(1, 5))
+
+    conn.executemany(
+        """INSERT INTO products (farmer_id, name, description, price, sold, created_at, review_count, rating_sum)
+           VALUES (?,?,?,?,?,?,?,?)""", rows())
+    conn.commit()
+
+
+def timed(conn, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def run(size, repeat=5):
+    rng = random.Random(size)
+    with tempfile.TemporaryDirectory() as tmp:
+        farm.app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        with farm.app.app_context():
+            farm.init_db()
+            conn = farm.get_db()
+            start = time.perf_counter()
+            populate(conn, size, rng)
+            print(f"\n{size:,} products (loaded in {time.perf_counter() - start:.1f}s)")
+            print(f"{'query':<16}{'LIKE ms':>10}{'FTS ms':>10}{'speedup':>10}")
+            params = {'weight': farm.app.config['SEARCH_RATING_WEIGHT'],
+                      'after_score': None, 'after_id': None, 'limit': LIMIT}
+            for q in QUERIES:
+                like = timed(conn, LIKE_SQL, (f'%{q}%', f'%{q}%', LIMIT), repeat)
+                fts = timed(conn, farm.SEARCH_SQL.format(filters=''), {**params, 'match': farm.fts_query(q)}, repeat)
+                print(f"{q:<16}{like:>10.2f}{fts:>10.2f}{like / max(fts, 1e-6):>9.1f}x")
+        farm.db_pool.close_all()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('sizes', type=int, nargs='*', default=[10_000, 100_000, 1_000_000],
+                        help='catalog sizes, one run each')
+    for n in parser.parse_args().sizes:
+        run(n)
@@ -0,0 +1,198 @@
+"""Fill a database with synthetic marketplace data at a chosen scale.
+
+    python benchmarks/seed_data.py /tmp/load.db                 # --scale small
+    python benchmarks/seed_data.py /tmp/load.db --scale large --seed 7
+
+The same seed always produces the same rows. Distributions are skewed the way
+a real marketplace is: a few farmers list most products, recent listings
+outnumber old ones, prices vary per crop, and most reviews are 4-5 stars.
+Product names mix English, transliterated Kannada and Kannada script.
+
+Everyone's password is "password". Other benchmarks import generate().
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as farm  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+SCALES = {
+    'tiny':   {'farmers': 20, 'buyers': 100, 'products': 1_000},
+    'small':  {'farmers': 200, 'buyers': 2_000, 'products': 20_000},
+    'medium': {'farmers': 2_000, 'buyers': 20_000, 'products': 200_000},
+    'large':  {'farmers': 10_000, 'buyers': 100_000, 'products': 1_000_000},
+}
+SOLD_SHARE = 0.3          # of products, each with one order
+REVIEWED_SHARE = 0.4      # of orders that get a review
+CART_ITEMS_PER_BUYER = 2  # on average, unsold products only
+HISTORY_DAYS = 365
+
+# (name, base price per unit in rupees); names in three spellings
+CROPS = [
+    (('rice', 'akki', 'ಅಕ್ಕಿ'), 55), (('wheat', 'godhi', 'ಗೋಧಿ'), 35), (('finger millet', 'ragi', 'ರಾಗಿ'), 40),
+    (('horse gram', 'huruli', 'ಹುರುಳಿ'), 90), (('pigeon pea', 'togari', 'ತೊಗರಿ'), 120),
+    (('chickpea', 'kadale', 'ಕಡಲೆ'), 80), (('beans', 'hasi avare', 'ಅವರೆ'), 60), (('paddy', 'bhatta', 'ಭತ್ತ'), 25),
+    (('sugar', 'sakkare', 'ಸಕ್ಕರೆ'), 45), (('coconut', 'tengu', 'ತೆಂಗು'), 30), (('banana', 'baale hannu', 'ಬಾಳೆಹಣ್ಣು'), 50),
+    (('tomato', 'tomato', 'ಟೊಮೆಟೊ'), 25), (('onion', 'eerulli', 'ಈರುಳ್ಳಿ'), 30), (('mango', 'maavu', 'ಮಾವು'), 110),
+    (('jowar', 'jola', 'ಜೋಳ'), 38), (('groundnut', 'kadlekai', 'ಕಡಲೆಕಾಯಿ'), 95), (('arecanut', 'adike', 'ಅಡಿಕೆ'), 450),
+    (('coffee', 'coffee', 'ಕಾಫಿ'), 300), (('turmeric', 'arishina', 'ಅರಿಶಿನ'), 140), (('jaggery', 'bella', 'ಬೆಲ್ಲ'), 60),
+]
+VARIETIES = ['', '', 'organic', 'fresh', 'premium', 'local', 'new harvest', 'sun dried', 'hand picked', 'ಸಾವಯವ']
+PLACES = ['Mandya', 'Hassan', 'Tumakuru', 'Mysuru', 'Belagavi', 'Raichur', 'Shivamogga', 'Kolar', 'Chikkamagaluru',
+          'Dharwad', 'Ballari', 'Kodagu', 'ಮಂಡ್ಯ', 'ಹಾಸನ']
+UNITS = ['per kg', 'per quintal', 'per dozen', '50 kg bag']
+FIRST_NAMES = ['Ramesh', 'Manjunath', 'Lakshmi', 'Basavaraj', 'Shivanna', 'Kavya', 'Nagaraj', 'Savitha', 'Mahesh',
+               'Prakash', 'Shobha', 'Anand', 'ಮಂಜುನಾಥ', 'ಲಕ್ಷ್ಮಿ', 'ಬಸವರಾಜ', 'ಶಿವಣ್ಣ']
+LAST_NAMES = ['Gowda', 'Patil', 'Hegde', 'Naik', 'Shetty', 'Rao', 'Reddy', 'Kulkarni', 'ಗೌಡ', 'ಪಾಟೀಲ']
+RATINGS, RATING_WEIGHTS = (1, 2, 3, 4, 5), (4, 6, 14, 36, 40)
+REVIEW_TEXTS = ['Good quality', 'Fresh and clean', 'As described', 'ಚೆನ್ನಾಗಿದೆ', 'Bit expensive', 'Will buy again', '']
+
+
+def chunked(rows, size=5000):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def insert(conn, sql, rows):
+    """executemany in chunks; returns the number of rows inserted."""
+    count = 0
+    for batch in chunked(rows):
+        conn.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+
+def person(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def generate(conn, scale='small', seed=0, **counts):
+    """Add users, products, orders, reviews, cart rows and notifications.
+
+    `counts` overrides the scale's farmers/buyers/products. Returns the
+    number of rows written per table.
+    """
+    rng = random.Random(seed)
+    sizes = {**SCALES[scale], **counts}
+    now = datetime.utcnow()
+    start = now - timedelta(days=HISTORY_DAYS)
+    password = generate_password_hash('password')
+
+    def when(after=start):
+        # Anywhere between `after` and now, more likely late than early
+        # (density rising linearly towards now): recent activity is denser
+        # than old activity, yet the whole span is covered.
+        return after + (now - after) * rng.betavariate(2, 1)
+
+    written = {}
+    base_user = conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]
+    users = []
+    for role in ('farmer', 'buyer'):
+        for _ in range(sizes[role + 's']):
+            # Sellers joined evenly over the history; buyers keep arriving.
+            joined = start + (now - start) * rng.random() if role == 'farmer' else when()
+            users.append((role, person(rng), f'{role}{base_user + len(users)}@example.com',
+                          f'9{base_user + len(users):09d}', password, joined.isoformat()))
+    written['users'] = insert(conn, """INSERT INTO users (role, name, email, phone, password_hash, created_at)
+                                       VALUES (?,?,?,?,?,?)""", users)
+    farmer_ids = range(base_user + 1, base_user + 1 + sizes['farmers'])
+    buyer_ids = range(farmer_ids.stop, farmer_ids.stop + sizes['buyers'])
+    farmer_since = {uid: datetime.fromisoformat(users[uid - base_user - 1][5]) for uid in farmer_ids}
+    del users
+
+    # A few farmers list most of the catalog (Pareto-distributed shares).
+    weights = [rng.paretovariate(1.5) for _ in farmer_ids]
+    owners = rng.choices(farmer_ids, weights=weights, k=sizes['products'])
+    base_product = conn.execute("SELECT COALESCE(MAX(id), 0) FROM products").fetchone()[0]
+    sold, unsold, listed = [], [], {}
+
+    def products():
+        for i, farmer_id in enumerate(owners):
+            names, base_price = rng.choice(CROPS)
+            name = f"{rng.choice(VARIETIES)} {rng.choice(names)}".strip()
+            since = farmer_since[farmer_id]
+            pid = base_product + 1 + i
+            is_sold = rng.random() < SOLD_SHARE
+            (sold if is_sold else unsold).append(pid)
+            if is_sold:
+                # Pick the sale first, anywhere in the farmer's time here and
+                # weighted towards recent, then list the product some time
+                # before it; drawing the listing first and the sale inside
+                # its remaining lifetime leaves almost no old orders.
+                ordered = when(since)
+                created = since + (ordered - since) * rng.betavariate(2, 1)
+                listed[pid] = (farmer_id, ordered)
+            else:
+                created = when(since)
+            price = round(base_price * rng.lognormvariate(0, 0.35), 2)
+            yield (farmer_id, name.capitalize(), f"{rng.choice(UNITS)}, {rng.choice(PLACES)}", price,
+                   f'9{farmer_id:09d}', int(is_sold), created.isoformat())
+
+    written['products'] = insert(conn, """INSERT INTO products
+        (farmer_id, name, description, price, phone, sold, created_at) VALUES (?,?,?,?,?,?,?)""", products())
+
+    orders, reviews, notes = [], [], []
+    for pid in sold:
+        farmer_id, ordered = listed[pid]
+        buyer_id = rng.choice(buyer_ids)
+        orders.append((pid, buyer_id, farmer_id, 'placed_cod', ordered.isoformat()))
+        notes.append((farmer_id, f"Your product #{pid} was ordered (Cash on Delivery).", 1, ordered.isoformat()))
+        notes.append((buyer_id, f"Order placed for product #{pid} (COD).", 1, ordered.isoformat()))
+        if rng.random() < REVIEWED_SHARE:
+            rating = rng.choices(RATINGS, RATING_WEIGHTS)[0]
+            # Most buyers review within a week or two of ordering.
+            reviewed = min(ordered + timedelta(days=rng.expovariate(1 / 7)), now).isoformat()
+            reviews.append((pid, buyer_id, rating, rng.choice(REVIEW_TEXTS), reviewed))
+            notes.append((farmer_id, f"New {rating}★ review on product #{pid}.", int(rng.random() < 0.7), reviewed))
+    del listed
+    written['orders'] = insert(conn, """INSERT INTO orders (product_id, buyer_id, farmer_id, status, created_at)
+                                        VALUES (?,?,?,?,?)""", orders)
+    written['reviews'] = insert(conn, """INSERT INTO reviews (product_id, buyer_id, rating, text, created_at)
+                                         VALUES (?,?,?,?,?)""", reviews)
+    notes.sort(key=lambda n: n[3])
+    written['notifications'] = insert(conn, """INSERT INTO notifications (user_id, message, is_read, created_at)
+                                               VALUES (?,?,?,?)""", notes)
+    del orders, reviews, notes
+
+    cart = set()
+    if unsold:
+        for _ in range(int(sizes['buyers'] * CART_ITEMS_PER_BUYER)):
+            cart.add((rng.choice(buyer_ids), rng.choice(unsold)))
+    written['cart'] = insert(conn, "INSERT INTO cart (buyer_id, product_id, added_at) VALUES (?,?,?)",
+                             ((b, p, when(now - timedelta(days=14)).isoformat()) for b, p in sorted(cart)))
+    conn.commit()
+    conn.execute("ANALYZE")
+    return written
+
+
+def seed_database(path, scale='small', seed=0, **counts):
+    """Create a fresh database at `path` with the app's schema and fill it."""
+    farm.app.config['DATABASE'] = path
+    with farm.app.app_context():
+        farm.init_db()
+        return generate(farm.get_db(), scale, seed, **counts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='SQLite file to create (must not exist)')
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    for table in ('farmers', 'buyers', 'products'):
+        parser.add_argument(f'--{table}', type=int, help=f'override the number of {table}')
+    args = parser.parse_args()
+    if os.path.exists(args.database):
+        parser.error(f'{args.database} already exists')
+    overrides = {k: getattr(args, k) for k in ('farmers', 'buyers', 'products') if getattr(args, k) is not None}
+    started = time.perf_counter()
+    written = seed_database(args.database, args.scale, args.seed, **overrides)
+    farm.db_pool.close_all()
+    print(', '.join(f'{n:,} {table}' for table, n in written.items()),
+          f'in {time.perf_counter() - started:.1f}s')
@@ -0,0 +1,149 @@
+"""Pages still load while notification streams are held open.
+
+    python benchmarks/stream_benchmark.py                       # 1 worker x 4 threads, 8 streams
+    python benchmarks/stream_benchmark.py --threads 8 --open 32 --streams 6
+
+Starts serve.py on a tiny seeded database, opens --open event streams as
+different buyers and keeps them open, then times plain page requests
+against the same worker. Each open stream holds a request thread, so
+without a cap the pages would queue behind them until the streams end.
+Exits non-zero if a page fails or times out, or if the worker accepted more
+streams than its cap.
+"""
+import argparse
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed_data import farm, seed_database  # noqa: E402
+
+SECRET_KEY = 'stream-benchmark'
+SERVE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'serve.py'))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not come up')
+
+
+def session_cookie(user_id):
+    """A signed Flask session for `user_id`, as the login form would set it."""
+    farm.app.config['SECRET_KEY'] = SECRET_KEY
+    value = farm.app.session_interface.get_signing_serializer(farm.app).dumps(
+        {'user_id': user_id, 'role': 'buyer', 'name': f'Buyer {user_id}'})
+    return f"{farm.app.config['SESSION_COOKIE_NAME']}={value}"
+
+
+def open_stream(port, user_id):
+    """Start an event stream and return its response; a 200 is left open.
+
+    The response owns the socket once the headers are read, so the caller
+    must keep it to keep the stream open."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', '/api/notifications/stream', headers={'Cookie': session_cookie(user_id)})
+    resp = conn.getresponse()
+    if resp.status == 200:
+        resp.fp.readline()   # the first `retry:` line, so the handler is really running
+    else:
+        resp.read()
+        resp.close()
+    return resp
+
+
+def timed_page(port, timeout):
+    started = time.perf_counter()
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+        return resp.status, (time.perf_counter() - started) * 1000
+    except OSError:
+        return None, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=4, help='request threads of the one worker')
+    parser.add_argument('--streams', type=int, help="the worker's stream cap (serve.py's default if omitted)")
+    parser.add_argument('--open', type=int, default=8, help='streams to try to hold open')
+    parser.add_argument('--requests', type=int, default=50, help='page requests to time meanwhile')
+    parser.add_argument('--timeout', type=float, default=5, help='seconds before a page counts as failed')
+    args = parser.parse_args()
+    cap = args.threads // 2 if args.streams is None else args.streams
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'bench.db')
+        seed_database(database, 'tiny')
+        with farm.app.app_context():
+            buyer_ids = [r[0] for r in farm.get_db().execute(
+                "SELECT id FROM users WHERE role='buyer' ORDER BY id LIMIT ?", (args.open,))]
+        farm.db_pool.close_all()
+
+        port = free_port()
+        command = [sys.executable, SERVE, '--host', '127.0.0.1', '--port', str(port), '--workers', '1',
+                   '--threads', str(args.threads)]
+        if args.streams is not None:
+            command += ['--streams', str(args.streams)]
+        env = {**os.environ, 'DATABASE': database, 'SECRET_KEY': SECRET_KEY}
+        server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        streams = []
+        try:
+            wait_until_up(port)
+            statuses = []
+            for uid in buyer_ids:
+                try:
+                    resp = open_stream(port, uid)
+                except OSError:   # no thread left to even answer
+                    statuses.append(None)
+                    continue
+                statuses.append(resp.status)
+                if resp.status == 200:
+                    streams.append(resp)
+            accepted, refused = statuses.count(200), statuses.count(503)
+            print(f"{args.threads} threads, cap {cap}: {accepted} streams open, {refused} refused (503), "
+                  f"{len(statuses) - accepted - refused} other")
+
+            results = [timed_page(port, args.timeout) for _ in range(args.requests)]
+        finally:
+            for resp in streams:
+                resp.close()
+            server.terminate()
+            server.wait(timeout=60)
+
+    ms = sorted(took for status, took in results if status == 200)
+    failed = len(results) - len(ms)
+    if ms:
+        print(f"GET / x{len(results)} with the streams open: p50 {statistics.median(ms):.1f}ms, "
+              f"max {ms[-1]:.1f}ms, failed {failed}")
+    else:
+        print(f"GET / x{len(results)} with the streams open: all failed")
+    ok = not failed and accepted <= cap
+    print('OK' if ok else 'FAILED')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""Production server: pre-forked worker processes, each with a thread pool.
+
+    python serve.py                                  # 0.0.0.0:8000, one worker per CPU
+    python serve.py --port 8080 --workers 4 --threads 16
+    python serve.py --threads 16 --streams 4         # at most 4 notification streams per worker
+    python serve.py --catalog-snapshot               # listings and suggest from memory
+    python serve.py --maintenance                    # daily archival, vacuum and backups
+    SECRET_KEY=... DATABASE=/srv/farm/app.db python serve.py
+
+The master process applies migrations once, opens the listening socket and
+forks the workers; each worker warms its caches before it starts accepting
+connections. A worker that dies is replaced. SIGTERM or Ctrl-C stops
+accepting new connections, lets in-flight requests (checkouts included)
+finish for up to --grace seconds, flushes queued notifications and exits.
+
+A notification stream holds one of its worker's threads for as long as it
+is open, so each worker accepts at most --streams of them (half its threads
+by default) and turns the rest away with a 503; those pages poll instead.
+
+Only the standard library and Werkzeug are used. Where os.fork is missing
+(Windows) a single worker runs in the master process.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+import app as farm
+
+log = logging.getLogger('serve')
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug's server with requests handled on a fixed-size thread pool
+    instead of one new thread per connection."""
+    multithread = True
+
+    def __init__(self, app, fd, threads):
+        super().__init__('127.0.0.1', 0, app, fd=fd)
+        self.threads = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+    def process_request(self, request, client_address):
+        self.threads.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def listen(host, port, backlog):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock, threads, grace):
+    """Serve on the shared socket until SIGTERM/SIGINT, then drain."""
+    started = time.perf_counter()
+    farm.warm_up()
+    server = PooledWSGIServer(farm.app, sock.fileno(), threads)
+    log.info("worker %d ready in %.2fs", os.getpid(), time.perf_counter() - started)
+
+    def stop(signum, frame):
+        farm.app_stopping.set()
+        # shutdown() waits for serve_forever to return, so not from its thread.
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    # No new connections; wait for the ones being handled, then tidy up.
+    drained = threading.Thread(target=server.threads.shutdown, kwargs={'wait': True}, daemon=True)
+    drained.start()
+    drained.join(grace)
+    if drained.is_alive():
+        log.warning("worker %d: requests still running after %ss", os.getpid(), grace)
+    try:
+        farm.drain_outbox()
+    except Exception:
+        log.exception("worker %d: could not flush notifications", os.getpid())
+    farm.db_pool.close_all()
+    log.info("worker %d stopped", os.getpid())
+
+
+def spawn(sock, threads, grace):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(sock, threads, grace)
+        except BaseException:
+            log.exception("worker %d crashed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def supervise(sock, workers, threads, grace):
+    """Keep `workers` children running until told to stop, then stop them."""
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+    children = {spawn(sock, threads, grace) for _ in range(workers)}
+    while not stopping.is_set():
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid in children:
+            children.discard(pid)
+            log.warning("worker %d exited (status %d); starting another", pid, status)
+            time.sleep(1)   # don't spin if every new worker dies at once
+            if not stopping.is_set():
+                children.add(spawn(sock, threads, grace))
+        stopping.wait(0.5)
+
+    log.info("stopping %d workers", len(children))
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+    deadline = time.monotonic() + grace + 5
+    while children and time.monotonic() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        children.discard(pid)
+        if pid == 0:
+            time.sleep(0.1)
+    for pid in children:
+        log.warning("killing worker %d", pid)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=16, help='request threads per worker')
+    parser.add_argument('--streams', type=int,
+                        help='notification streams per worker (default: half of --threads)')
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--grace', type=float, default=30, help='seconds to let requests finish on shutdown')
+    parser.add_argument('--catalog-snapshot', action='store_true',
+                        help='serve listings and suggestions from an in-memory copy of the catalog')
+    parser.add_argument('--maintenance', action='store_true',
+                        help='archive, optimize, vacuum and back up the database on a schedule')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    streams = args.threads // 2 if args.streams is None else args.streams
+    config = {'CATALOG_SNAPSHOT': args.catalog_snapshot, 'MAINTENANCE_WORKER': args.maintenance,
+              'NOTIFY_MAX_STREAMS': max(streams, 0)}
+    # Rate limit buckets must be shared for the limits to hold across workers.
+    if args.workers > 1:
+        config['RATE_LIMIT_STORE'] = 'sqlite'
+    farm.create_app(config)
+    with farm.app.app_context():
+        log.info("schema at version %d", farm.schema_version(farm.get_db()))
+    # Nothing opened so far may be shared with the workers.
+    farm.db_pool.close_all()
+
+    sock = listen(args.host, args.port, args.backlog)
+    log.info("listening on %s:%d with %d workers x %d threads", args.host, args.port, args.workers, args.threads)
+    if args.workers <= 1 or not hasattr(os, 'fork'):
+        run_worker(sock, args.threads, args.grace)
+    else:
+        supervise(sock, args.workers, args.threads, args.grace)
+    sock.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
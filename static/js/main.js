@@ -2,23 +2,246 @@
 const q = document.getElementById('search-input');
 const box = document.getElementById('suggestions');
 if(q){
-  q.addEventListener('input', async () => {
-    const val = q.value.trim();
-    if(!val){ box.style.display='none'; return; }
-    const res = await fetch(`/api/suggest?q=${encodeURIComponent(val)}`);
-    const data = await res.json();
+  const DEBOUNCE_MS = 200;
+  const CACHE_MAX = 100;
+  const cache = new Map();      // query -> suggestions, oldest first
+  let timer = null;
+  let inflight = null;
+  let pausedUntil = 0;         // after a 429, until Retry-After has passed
+
+  const render = (data) => {
     if(!data.length){ box.style.display='none'; return; }
     box.innerHTML = '';
     data.forEach(it => {
       const row = document.createElement('div');
       row.className = 'item';
-      row.innerHTML = `<span>${it.name}</span><small>★ ${Number(it.avg_rating).toFixed(1)} • ${it.review_count} reviews</small>`;
+      const name = document.createElement('span');
+      name.textContent = it.name;
+      const meta = document.createElement('small');
+      meta.textContent = `★ ${Number(it.avg_rating).toFixed(1)} • ${it.review_count} reviews`;
+      row.append(name, meta);
       row.onclick = () => { q.value = it.name; box.style.display='none'; };
       box.appendChild(row);
     });
     box.style.display = 'block';
+  };
+
+  const remember = (key, data) => {
+    cache.delete(key);
+    cache.set(key, data);
+    if(cache.size > CACHE_MAX) cache.delete(cache.keys().next().value);
+  };
+
+  const suggest = async (val) => {
+    const key = val.toLowerCase().replace(/\s+/g, ' ');
+    if(cache.has(key)){ render(cache.get(key)); return; }
+    if(Date.now() < pausedUntil) return;
+    // A newer keystroke wins: drop the previous request instead of racing it.
+    if(inflight) inflight.abort();
+    inflight = new AbortController();
+    try {
+      const res = await fetch(`/api/suggest?q=${encodeURIComponent(val)}`, {signal: inflight.signal});
+      if(res.status === 429){
+        // Typing faster than the server allows: stay quiet until told.
+        pausedUntil = Date.now() + 1000 * (Number(res.headers.get('Retry-After')) || 1);
+        return;
+      }
+      if(!res.ok) return;
+      const data = await res.json();
+      remember(key, data);
+      if(q.value.trim() === val) render(data);
+    } catch(err) {
+      if(err.name !== 'AbortError') console.error('Suggest failed:', err);
+    }
+  };
+
+  q.addEventListener('input', () => {
+    const val = q.value.trim();
+    clearTimeout(timer);
+    if(!val){
+      if(inflight) inflight.abort();
+      box.style.display='none';
+      return;
+    }
+    timer = setTimeout(() => suggest(val), DEBOUNCE_MS);
   });
   document.addEventListener('click', (e)=>{
     if(!box.contains(e.target) && e.target !== q) box.style.display='none';
   });
 }
+
+// Infinite scroll: a .load-more link fetches the next page's items
+// (?partial=...) into its data-target container; X-Next-Page says what's next.
+const loadMore = async (link, observer) => {
+  observer.unobserve(link);
+  const url = new URL(link.href, location.href);
+  url.searchParams.set('partial', link.dataset.partial);
+  try {
+    const res = await fetch(url);
+    if(!res.ok) throw new Error(res.status);
+    const tpl = document.createElement('template');
+    tpl.innerHTML = await res.text();
+    document.getElementById(link.dataset.target).append(tpl.content);
+    const next = res.headers.get('X-Next-Page');
+    if(next){ link.href = next; observer.observe(link); }
+    else link.remove();
+  } catch(err) {
+    console.error('Loading more failed:', err);   // the link still works as a plain page link
+  }
+};
+if('IntersectionObserver' in window){
+  const observer = new IntersectionObserver((entries) => {
+    entries.forEach(e => { if(e.isIntersecting) loadMore(e.target, observer); });
+  }, {rootMargin: '400px'});
+  document.querySelectorAll('.load-more').forEach(link => observer.observe(link));
+}
+
+// Notifications: first page from the JSON API, then pushed over an
+// EventSource stream; "Mark all read" clears everything shown so far. When
+// the server is too busy for another stream (503) the page polls the API for
+// a while and then asks for a stream again.
+const notes = document.getElementById('notifications');
+if(notes){
+  const badge = document.getElementById('notify-unread');
+  const readAll = document.getElementById('notify-read-all');
+  const POLL_MS = 30000, POLLS_BEFORE_RETRY = 4;
+  let newest = 0;
+
+  const setUnread = (n) => {
+    badge.textContent = n;
+    badge.hidden = readAll.hidden = !n;
+  };
+  const item = (n) => {
+    const li = document.createElement('li');
+    li.className = n.is_read ? '' : 'unread';
+    const when = document.createElement('small');
+    when.textContent = n.created_at;
+    li.append(`🔔 ${n.message} `, when);
+    return li;
+  };
+  const add = (items, atTop) => {
+    if(!items.length) return;
+    notes.querySelector('.empty')?.remove();
+    items.forEach(n => {
+      newest = Math.max(newest, n.id);
+      if(atTop) notes.prepend(item(n)); else notes.append(item(n));
+    });
+  };
+
+  readAll.addEventListener('click', async () => {
+    const res = await fetch(notes.dataset.read, {
+      method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({up_to: newest}),
+    });
+    if(!res.ok) return;
+    setUnread((await res.json()).unread);
+    notes.querySelectorAll('li.unread').forEach(li => li.classList.remove('unread'));
+  });
+
+  // The API lists newest first; only rows past `newest` are new here.
+  const poll = async () => {
+    try {
+      const res = await fetch(notes.dataset.src);
+      if(!res.ok) throw new Error(res.status);
+      const data = await res.json();
+      add(data.items.filter(n => n.id > newest).reverse(), true);
+      setUnread(data.unread);
+    } catch(err) {
+      console.error('Polling notifications failed:', err);
+    }
+  };
+
+  const listen = () => {
+    const stream = new EventSource(`${notes.dataset.stream}?after=${newest}`);
+    stream.addEventListener('notification', (e) => {
+      const data = JSON.parse(e.data);
+      add(data.items, true);
+      setUnread(data.unread);
+    });
+    stream.addEventListener('error', () => {
+      // A dropped stream reconnects by itself; a refused one is CLOSED.
+      if(stream.readyState !== EventSource.CLOSED) return;
+      let polls = 0;
+      const timer = setInterval(async () => {
+        await poll();
+        if(++polls >= POLLS_BEFORE_RETRY){
+          clearInterval(timer);
+          listen();
+        }
+      }, POLL_MS);
+    });
+  };
+
+  (async () => {
+    try {
+      const res = await fetch(notes.dataset.src);
+      if(!res.ok) throw new Error(res.status);
+      const data = await res.json();
+      add(data.items, false);
+      setUnread(data.unread);
+    } catch(err) {
+      console.error('Loading notifications failed:', err);
+    }
+    if('EventSource' in window) listen();
+  })();
+}
+
+// Cart: the header badge comes from the summary endpoint; "Add to Cart",
+// quantity changes and "Remove" go through the JSON cart API in place of a
+// page load. The plain links and the cart form still work without this.
+const cartBadge = document.getElementById('cart-badge');
+if(cartBadge){
+  const total = document.getElementById('cart-total');
+
+  const showSummary = (s) => {
+    cartBadge.textContent = s.quantity;
+    cartBadge.hidden = !s.quantity;
+    if(total) total.textContent = s.total.toFixed(2);
+  };
+  const cartApi = async (method, body) => {
+    const res = await fetch(cartBadge.dataset.items, {
+      method, headers: {'Content-Type': 'application/json'}, body: JSON.stringify(body),
+    });
+    const data = await res.json();
+    if(!res.ok) throw new Error(data.error || res.status);
+    showSummary(data);
+    return data;
+  };
+
+  fetch(cartBadge.dataset.src)
+    .then(res => res.ok ? res.json() : Promise.reject(res.status))
+    .then(showSummary)
+    .catch(err => console.error('Loading cart failed:', err));
+
+  document.addEventListener('click', async (e) => {
+    const add = e.target.closest('[data-cart-add]');
+    const remove = e.target.closest('[data-cart-remove]');
+    if(!add && !remove) return;
+    e.preventDefault();
+    try {
+      if(add){
+        const data = await cartApi('POST', {product_id: Number(add.dataset.cartAdd)});
+        add.textContent = data.unavailable_ids.length ? 'Not available' : 'In cart ✓';
+      } else {
+        await cartApi('DELETE', {product_ids: [Number(remove.dataset.cartRemove)]});
+        remove.closest('.tile').remove();
+      }
+    } catch(err) {
+      console.error('Cart update failed:', err);
+      location.href = (add || remove).href;   // fall back to the page route and its message
+    }
+  });
+
+  document.querySelectorAll('#cart .qty').forEach(input => {
+    input.addEventListener('change', async () => {
+      const tile = input.closest('[data-cart-item]');
+      const quantity = Math.max(0, Math.floor(Number(input.value) || 0));
+      try {
+        await cartApi('POST', {product_id: Number(tile.dataset.cartItem), quantity});
+        if(!quantity) tile.remove();
+      } catch(err) {
+        console.error('Cart update failed:', err);
+      }
+    });
+  });
+  document.getElementById('cart')?.addEventListener('submit', (e) => e.preventDefault());
+}